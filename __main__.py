@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 import re
+import atexit
 import random
 import appdirs
 import argparse
@@ -12,10 +13,16 @@ try:
 except ImportError:
     pass
 
-from ecache import Cache
+import perf
+from ecache import Cache, RateLimiter
 from util import *
 from xmltv import *
 from ui import *
+from sync import sync
+from export import export, FORMATS
+from serve import serve, parse_address
+from board import print_board
+from search import ProgramSearch, print_search
 
 __version__ = (1, 2, 4)
 __version_info__ = ".".join(map(str, __version__))
@@ -49,11 +56,18 @@ def print_license():
 
 cache = Cache((APP_NAME, APP_AUTHOR), "{}/{}".format(APP_NAME, APP_VERSION))
 
-def load_channels(channels, start, end):
-    for chan in channels:
-        with Progress("Loading channel {}".format(chan.id), overwrite=True):
-            chan.fetch(start, cache)
-            chan.fetch(end, cache)
+def load_channels(channels, start, end, jobs=8):
+    dates = sorted({start, end})
+    total = len(channels) * len(dates)
+    progress = Progress("Loading channels (0/{})".format(total), overwrite=True)
+    done = 0
+    def loaded(chan, d):
+        nonlocal done
+        done += 1
+        progress.msg = "Loading channels ({}/{})".format(done, total)
+
+    with progress:
+        fetch_programs(channels, dates, cache, jobs=jobs, callback=loaded)
     return channels
 
 def main():
@@ -77,8 +91,36 @@ def main():
             help="The duration (HH:MM:SS) the query will cover. Defaults to 2 hours.")
     parser.add_argument("-p", "--cache-first", action="store_true",
             help="Try to load the cached content before checking if it's outdated.")
+    parser.add_argument("--parser", choices=sorted(PROGRAM_PARSERS), default=TVChannel.parser,
+            help="The XML parser used to read program listings. Defaults to iterparse.")
+    parser.add_argument("-j", "--jobs", default=8, type=int,
+            help="The number of listings downloaded at once. Defaults to 8.")
+    parser.add_argument("--sync", metavar="DAYS", type=int,
+            help="Download the listings of the given channels (or every channel) for DAYS days from the queried date into the cache, then exit. "
+                 "An interrupted sync resumes where it stopped; listings that fail are retried by the next run.")
+    parser.add_argument("--format", choices=FORMATS,
+            help="Write the programs of the given channels (or every channel) in the queried range to standard output "
+                 "in this format, then exit.")
+    parser.add_argument("--serve", metavar="[HOST:]PORT", type=parse_address,
+            help="Keep the listings of the given channels (or every channel) loaded, and answer queries on them "
+                 "over HTTP/JSON at this address (on the local host by default).")
+    parser.add_argument("--now", action="store_true",
+            help="Show what is on, and on next, at the queried time across the given channels (or every channel), then exit.")
+    parser.add_argument("--search", metavar="QUERY",
+            help="Search the titles, descriptions, credits and categories of the cached listings (of the given "
+                 "channels, if any), then exit. A query ending in * matches words starting with its last word.")
+    parser.add_argument("--rate", default=None, type=float,
+            help="The most requests per second sent to each host. Defaults to 4 when syncing, and no limit otherwise.")
+    parser.add_argument("--cache-size", default=256, type=float,
+            help="The size (in MiB) the cache is kept under. Defaults to 256.")
+    parser.add_argument("--cache-stats", action="store_true",
+            help="Show cache statistics and exit.")
     parser.add_argument("-v", "--verbose", action="store_true",
             help="Print a greater amount of log output.")
+    parser.add_argument("--profile", action="store_true",
+            help="Time downloading, parsing, listing and drawing, and print where the time went on exit.")
+    parser.add_argument("--profile-json", metavar="FILE",
+            help="Like --profile, but write the timings as JSON to FILE (- for standard output).")
     args = parser.parse_args()
 
     if args.license:
@@ -90,8 +132,35 @@ def main():
     if args.verbose:
         cache.verbose = True
 
-    with Progress("Loading channels", overwrite=True):
+    if args.profile or args.profile_json:
+        perf.enable()
+        perf.include("cache", lambda: cache.counters)
+        atexit.register(perf.write_report, args.profile_json)
+
+    cache.max_bytes = int(args.cache_size * 1024 * 1024)
+    if args.cache_stats:
+        for key, value in cache.stats().items():
+            print("{}: {}".format(key, value))
+        exit(0)
+
+    # keep a persistent connection open for each concurrent download
+    cache.pool.size = max(cache.pool.size, args.jobs)
+
+    TVChannel.parser = args.parser
+
+    if args.search is not None:
+        quiet_pipe(print_search, ProgramSearch(cache), args.search, channels=args.channel or None)
+        exit(0)
+
+    if args.format is not None:
+        # keep standard output for the listings
         channels = parse_channels(args.channel_url, cache)
+    else:
+        with Progress("Loading channels", overwrite=True):
+            channels = parse_channels(args.channel_url, cache)
+
+    if args.rate or args.sync is not None:
+        cache.pool.limiter = RateLimiter(args.rate or 4)
 
     valid_channels = []
     if len(args.channel) > 0:
@@ -99,19 +168,47 @@ def main():
             if id in channels:
                 valid_channels.append(channels[id])
             else:
-                print("Channel {} not found.".format(id))
+                print("Channel {} not found.".format(id), file=sys.stderr if args.format else sys.stdout)
 
-    if len(valid_channels) == 0:
-        valid_channels = ask_channels(channels)
+    # the batch modes fall back to every channel only when none were given
+    batch = args.sync is not None or args.serve is not None or args.now or args.format is not None
+    if batch and len(args.channel) > 0 and len(valid_channels) == 0:
+        print("None of the given channels were found.", file=sys.stderr)
+        exit(1)
+
+    if args.sync is not None:
+        done, failed = sync(valid_channels or list(channels.values()), cache, args.sync, jobs=args.jobs,
+                            start=args.date, index=ProgramSearch(cache))
+        exit(1 if failed else 0)
+
+    if args.serve is not None:
+        serve(valid_channels or channels, cache, args.serve, jobs=args.jobs, verbose=args.verbose,
+              channel_url=args.channel_url)
+        exit(0)
 
     start = datetime.combine(args.date, args.time)
     end = start + args.range
-    load_channels(valid_channels, start.date(), end.date())
+
+    if args.now:
+        print_board(valid_channels or list(channels.values()), cache, start, jobs=args.jobs)
+        exit(0)
+
+    if args.format is not None:
+        quiet_pipe(export, valid_channels or list(channels.values()), cache, start, end, args.format, jobs=args.jobs)
+        exit(0)
+
+    if len(valid_channels) == 0:
+        valid_channels = ask_channels(channels)
+    load_channels(valid_channels, start.date(), end.date(), jobs=args.jobs)
 
     #epg_navigation(valid_channels, start, end, cache)
-    epg = EPG(valid_channels, start, end, cache)
-    while True:
-        epg.listener()
+    epg = EPG(valid_channels, start, end, cache, jobs=args.jobs)
+    perf.include("epg", epg.stats)
+    try:
+        while True:
+            epg.listener()
+    finally:
+        epg.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+# Generates a synthetic XMLTV feed laid out like the real one: a gzipped
+# channels.xml.gz directory, and a <id>_<date>.xml.gz listing for each
+# channel and day.
+#
+#   python3 bench/feed.py OUT [--channels N] [--days N] [--programs N] [--base-url URL]
+
+import os
+import sys
+import gzip
+import random
+import argparse
+from datetime import date, datetime, timedelta
+from xml.sax.saxutils import escape, quoteattr
+
+TITLES = ["News", "Sport", "Weather", "Gardening Australia", "Landline", "Rage", "Four Corners",
+          "Play School", "Antiques Roadshow", "Grand Designs", "Midsomer Murders", "Insiders",
+          "The Drum", "Back Roads", "Gruen", "Hard Quiz", "Doctor Who", "Spicks and Specks"]
+WORDS = ("the a of and to in is on for with as by at from this that an be are was his her their "
+         "new old city country family story life night day world home road river team season house "
+         "secret final first last great little young second return journey murder mystery garden").split()
+CATEGORIES = ["News", "Drama", "Sport", "Movie", "Documentary", "Comedy", "Lifestyle", "Children", "Music"]
+RATINGS = ["G", "PG", "M", "MA15+"]
+NAMES = ["Alex", "Sam", "Jo", "Chris", "Robin", "Jamie", "Pat", "Kim", "Lee", "Morgan"]
+SURNAMES = ["Smith", "Nguyen", "Jones", "Williams", "Brown", "Wilson", "Taylor", "Lee", "Martin", "Walker"]
+# listings run from 6 am to 6 am the next day
+DAY_START = timedelta(0, 6*60*60)
+OFFSET = "+1000"
+
+def channel_ids(channels):
+    return ["CH{:03d}-NSW".format(i) for i in range(channels)]
+
+def days(count, first=None):
+    first = first or date.today() - timedelta(1)
+    return [first + timedelta(i) for i in range(count)]
+
+def timestamp(dt):
+    return "{} {}".format(dt.strftime("%Y%m%d%H%M%S"), OFFSET)
+
+def sentence(rand, low, high):
+    words = rand.choices(WORDS, k=rand.randint(low, high))
+    return " ".join(words).capitalize()
+
+def person(rand):
+    return "{} {}".format(rand.choice(NAMES), rand.choice(SURNAMES))
+
+def program_xml(rand, id, start, stop):
+    parts = ['<programme start="{}" stop="{}" channel="{}">'.format(timestamp(start), timestamp(stop), id),
+             '<title lang="en">{}</title>'.format(escape(rand.choice(TITLES)))]
+    if rand.random() < 0.6:
+        parts.append('<sub-title lang="en">{}</sub-title>'.format(escape(sentence(rand, 2, 5))))
+    parts.append('<desc lang="en">{}.</desc>'.format(escape(sentence(rand, 8, 40))))
+    if rand.random() < 0.3:
+        parts.append("<credits><director>{}</director>{}</credits>".format(
+            escape(person(rand)), "".join("<actor>{}</actor>".format(escape(person(rand))) for i in range(rand.randint(1, 4)))))
+    if rand.random() < 0.2:
+        parts.append("<date>{}</date>".format(rand.randint(1950, 2025)))
+    for category in rand.sample(CATEGORIES, rand.randint(1, 2)):
+        parts.append('<category lang="en">{}</category>'.format(category))
+    if rand.random() < 0.7:
+        parts.append('<rating system="ACMA"><value>{}</value></rating>'.format(rand.choice(RATINGS)))
+    parts.append("</programme>")
+    return "".join(parts)
+
+# Returns a day's listing for a channel, with `programs` programs of random
+# length (in five minute steps) filling the day.
+def listing_xml(rand, id, d, programs):
+    slots = 24*60 // 5
+    programs = max(1, min(programs, slots))
+    cuts = sorted(rand.sample(range(1, slots), programs - 1))
+    start = datetime.combine(d, datetime.min.time()) + DAY_START
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<tv>']
+    for a, b in zip([0] + cuts, cuts + [slots]):
+        parts.append(program_xml(rand, id, start + timedelta(0, a*5*60), start + timedelta(0, b*5*60)))
+    parts.append("</tv>")
+    return "\n".join(parts)
+
+def channels_xml(ids, dates, base_url):
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<tv>']
+    for i, id in enumerate(ids):
+        parts.append('<channel id={}><display-name lang="en">Channel {} Sydney</display-name>'.format(quoteattr(id), i))
+        parts.append("<base-url>{}</base-url>".format(escape(base_url)))
+        for d in dates:
+            modified = datetime.combine(d - timedelta(1), datetime.min.time()) + DAY_START
+            parts.append('<datafor lastmodified="{}">{}</datafor>'.format(timestamp(modified), d.isoformat()))
+        parts.append("</channel>")
+    parts.append("</tv>")
+    return "\n".join(parts)
+
+def write_gzip(path, text):
+    with open(path, "wb") as fp:
+        fp.write(gzip.compress(text.encode("utf-8"), compresslevel=6))
+
+# Writes a feed of `channels` channels, each with `count` days of listings
+# (starting yesterday) of about `programs` programs each, into out.
+# Returns the channel ids and dates written.
+def generate(out, base_url, channels=40, count=3, programs=48, seed=1):
+    os.makedirs(out, exist_ok=True)
+    rand = random.Random(seed)
+    ids = channel_ids(channels)
+    dates = days(count)
+    write_gzip(os.path.join(out, "channels.xml.gz"), channels_xml(ids, dates, base_url))
+    for id in ids:
+        for d in dates:
+            write_gzip(os.path.join(out, "{}_{}.xml.gz".format(id, d.isoformat())), listing_xml(rand, id, d, programs))
+    return ids, dates
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic XMLTV feed.")
+    parser.add_argument("out", help="The directory to write the feed into.")
+    parser.add_argument("--channels", default=40, type=int)
+    parser.add_argument("--days", default=3, type=int)
+    parser.add_argument("--programs", default=48, type=int, help="Programs per channel per day.")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8080/",
+                        help="The base URL the channel directory points listings at.")
+    parser.add_argument("--seed", default=1, type=int)
+    args = parser.parse_args()
+
+    ids, dates = generate(args.out, args.base_url, args.channels, args.days, args.programs, args.seed)
+    print("Wrote {} listings for {} channels to {}".format(len(ids) * len(dates), len(ids), args.out))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# Serves a directory of feed files over HTTP/1.1 the way the real feed
+# server does: with ETag and Last-Modified validators, answering
+# conditional requests with 304 Not Modified, after an added latency. It
+# counts the connections it accepts, and can close idle keep-alive
+# connections after a timeout as many servers do.
+#
+#   python3 bench/feedserver.py DIR [--port PORT] [--latency SECONDS] [--max-age SECONDS]
+#                               [--idle-timeout SECONDS]
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlsplit
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class FeedHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # an idle connection is closed once reading the next request times out
+        self.timeout = self.server.idle_timeout
+        self.server.count_connection()
+        super().setup()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        # requests sent through a proxy carry the whole URL
+        entry = server.entry(urlsplit(self.path).path)
+        if entry is None:
+            server.count("not_found")
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        data, etag, modified = entry
+        match = self.headers.get("If-None-Match")
+        since = self.headers.get("If-Modified-Since")
+        if match is not None:
+            not_modified = etag in [tag.strip() for tag in match.split(",")]
+        elif since is not None:
+            try:
+                not_modified = parsedate_to_datetime(since).timestamp() >= int(modified)
+            except (TypeError, ValueError):
+                not_modified = False
+        else:
+            not_modified = False
+
+        self.send_response(304 if not_modified else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(modified, usegmt=True))
+        if server.max_age is not None:
+            self.send_header("Cache-Control", "max-age={}".format(server.max_age))
+        if not_modified:
+            server.count("not_modified")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        server.count("ok", len(data))
+        self.send_header("Content-Type", "application/gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class FeedServer(ThreadingHTTPServer):
+    """Serves the files in directory, each after `latency` seconds, and
+        fresh for max_age seconds if given.
+
+        Files are read (and their ETags computed) once, on first request,
+        and again only if their modification time changes. Counts of the
+        connections accepted and responses sent are kept in self.counters.
+        Connections left idle for idle_timeout seconds are closed.
+    """
+    daemon_threads = True
+
+    def __init__(self, directory, port=0, latency=0, max_age=None, host="127.0.0.1", idle_timeout=None):
+        super().__init__((host, port), FeedHandler)
+        self.directory = os.path.abspath(directory)
+        self.latency = latency
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self.counters = {}
+        self._files = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.reset()
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.server_address[:2])
+
+    def reset(self):
+        with self._lock:
+            self.counters = { "connections": 0, "requests": 0, "ok": 0, "not_modified": 0,
+                              "not_found": 0, "bytes_sent": 0 }
+
+    def count_connection(self):
+        with self._lock:
+            self.counters["connections"] += 1
+
+    def count(self, status, size=0):
+        with self._lock:
+            self.counters["requests"] += 1
+            self.counters[status] += 1
+            self.counters["bytes_sent"] += size
+
+    # Returns (data, etag, mtime) for the file at the given URL path, or
+    # None if there is none.
+    def entry(self, path):
+        name = os.path.normpath(path.lstrip("/"))
+        if name.startswith(".."):
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._files.get(path)
+        if entry is None or entry[2] != mtime:
+            with open(path, "rb") as fp:
+                data = fp.read()
+            entry = (data, '"{}"'.format(hashlib.sha1(data).hexdigest()), mtime)
+            with self._lock:
+                self._files[path] = entry
+        return entry
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a feed directory with ETag/304 support.")
+    parser.add_argument("directory")
+    parser.add_argument("--port", default=8080, type=int)
+    parser.add_argument("--latency", default=0, type=float, help="Seconds to wait before each response.")
+    parser.add_argument("--max-age", type=int,
+                        help="The Cache-Control max-age to send; 0 makes clients revalidate every request.")
+    parser.add_argument("--idle-timeout", type=float,
+                        help="Close keep-alive connections left idle for this many seconds.")
+    args = parser.parse_args()
+
+    server = FeedServer(args.directory, args.port, args.latency, args.max_age, idle_timeout=args.idle_timeout)
+    print("Serving {} on {}".format(server.directory, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# Sends a mix of queries to a running `--serve` instance from several
+# connections at once, and reports the throughput and latencies seen.
+#
+#   python3 bench/loadtest.py [-c CONNECTIONS] [-d SECONDS] [URL]
+
+import sys
+import json
+import random
+import argparse
+import threading
+import http.client
+from time import perf_counter
+from urllib.parse import urlsplit, quote
+from datetime import datetime, timedelta
+
+# Returns the path of a random query, in roughly the mix a dashboard would
+# send: mostly now/next and range lookups, and some channel searches.
+def random_query(ids, now):
+    kind = random.random()
+    if kind < 0.4:
+        return "/now?channel=" + quote(",".join(random.sample(ids, min(len(ids), 4))))
+    start = now + timedelta(minutes=random.randrange(-12*60, 24*60, 30))
+    if kind < 0.8:
+        return "/channels/{}/programs?start={}&end={}".format(
+            quote(random.choice(ids)), start.isoformat(), (start + timedelta(hours=2)).isoformat())
+    if kind < 0.9:
+        return "/programs?channel={}&start={}&end={}".format(
+            quote(",".join(random.sample(ids, min(len(ids), 8)))), start.isoformat(), (start + timedelta(hours=1)).isoformat())
+    id = random.choice(ids)
+    return "/channels?limit=10&q=" + quote(id[:random.randint(1, len(id))])
+
+def worker(host, port, ids, deadline, results, lock):
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    latencies, errors, received = [], 0, 0
+    now = datetime.now()
+    while perf_counter() < deadline:
+        path = random_query(ids, now)
+        t = perf_counter()
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            body = resp.read()
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            continue
+        latencies.append(perf_counter() - t)
+        received += len(body)
+        if resp.status != 200:
+            errors += 1
+    conn.close()
+    with lock:
+        results["latencies"] += latencies
+        results["errors"] += errors
+        results["bytes"] += received
+
+def percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a quick-xmltv --serve instance.")
+    parser.add_argument("url", nargs="?", default="http://127.0.0.1:8080/")
+    parser.add_argument("-c", "--connections", default=8, type=int)
+    parser.add_argument("-d", "--duration", default=10, type=float)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    url = urlsplit(args.url)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+    conn.request("GET", "/channels")
+    ids = [chan["id"] for chan in json.loads(conn.getresponse().read())]
+    conn.close()
+    if not ids:
+        sys.exit("The server has no channels.")
+
+    results = { "latencies": [], "errors": 0, "bytes": 0 }
+    lock = threading.Lock()
+    start = perf_counter()
+    threads = [threading.Thread(target=worker, args=(url.hostname, url.port or 80, ids, start + args.duration, results, lock))
+               for i in range(args.connections)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = perf_counter() - start
+
+    latencies = sorted(results["latencies"])
+    report = {
+        "connections": args.connections,
+        "requests": len(latencies),
+        "errors": results["errors"],
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0,
+        "kib_per_second": round(results["bytes"] / elapsed / 1024, 1),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print("{}: {}".format(key, value))
+
+if __name__ == "__main__":
+    main()
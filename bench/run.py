@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+# Times the hot paths of quick-xmltv against a synthetic feed served from a
+# local server, and reports the results (as JSON, to compare between
+# commits, if asked).
+#
+#   python3 bench/run.py [--channels N] [--days N] [--programs N] [--latency S]
+#                        [--json] [-o FILE] [--compare FILE]
+
+import os
+import io
+import gc
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+from time import perf_counter
+from statistics import median
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ecache import Cache
+from xmltv import TVProgram, parse_channels, fetch_programs, get_program_listings
+from ui import print_epg, EPG
+from util import align_time
+from feed import generate
+from feedserver import FeedServer
+
+class Runner:
+    """Runs each benchmark `repeat` times, keeping the timings of each."""
+    def __init__(self, repeat=5, verbose=False):
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = []
+
+    # Times fn(setup()) over `repeat` runs, where each run carries out
+    # `ops` operations. Returns the value of the last run.
+    def measure(self, name, fn, setup=None, ops=1, repeat=None, extra=None):
+        times = []
+        value = None
+        for i in range(repeat or self.repeat):
+            state = setup() if setup is not None else None
+            gc.collect()
+            t = perf_counter()
+            value = fn(state)
+            times.append(perf_counter() - t)
+
+        result = {
+            "name": name,
+            "runs": len(times),
+            "ops": ops,
+            "min_ms": round(min(times) * 1000, 3),
+            "median_ms": round(median(times) * 1000, 3),
+            "mean_ms": round(sum(times) / len(times) * 1000, 3),
+            "max_ms": round(max(times) * 1000, 3),
+            "per_op_ms": round(median(times) / ops * 1000, 4),
+        }
+        if extra is not None:
+            result.update(extra() if callable(extra) else extra)
+        self.results.append(result)
+        if self.verbose:
+            print("{}: {} ms".format(name, result["median_ms"]), file=sys.stderr)
+        return value
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args, workdir):
+    # nothing stays fresh, so warm fetches cost a 304 each
+    server = FeedServer(os.path.join(workdir, "feed"), latency=args.latency, max_age=0).start()
+    try:
+        ids, dates = generate(server.directory, server.url, args.channels, args.days, args.programs)
+        channels_url = server.url + "channels.xml.gz"
+        runner = Runner(args.repeat, args.verbose)
+        caches = iter(range(1 << 30))
+
+        def new_cache(**kwargs):
+            return Cache(os.path.join(workdir, "cache-{}".format(next(caches))), pool_size=args.jobs, **kwargs)
+
+        def server_counts():
+            counts = dict(server.counters)
+            server.reset()
+            return counts
+
+        runner.measure("parse_channels.cold", lambda cache: parse_channels(channels_url, cache),
+                       setup=new_cache)
+        warm = new_cache()
+        parse_channels(channels_url, warm)
+        runner.measure("parse_channels.warm", lambda cache: parse_channels(channels_url, cache),
+                       setup=lambda: warm)
+
+        # fetch every channel-day into a fresh cache, then again (from new
+        # channels) against the warm cache: with the directory's last
+        # modified stamps, without them (revalidating each listing), and
+        # from the cache alone
+        listings = len(ids) * len(dates)
+        def fetch(state):
+            cache, channels = state
+            fetch_programs(channels, dates, cache, jobs=args.jobs)
+            return channels
+        def fresh_channels(cache):
+            channels = list(parse_channels(channels_url, cache).values())
+            server.reset()
+            return cache, channels
+
+        runner.measure("fetch.cold", fetch, setup=lambda: fresh_channels(new_cache()),
+                       ops=listings, repeat=min(args.repeat, 3), extra=server_counts)
+        warm = new_cache()
+        fetch(fresh_channels(warm))
+        runner.measure("fetch.warm", fetch, setup=lambda: fresh_channels(warm),
+                       ops=listings, extra=server_counts)
+        def unstamped_channels(cache):
+            cache, channels = fresh_channels(cache)
+            for chan in channels:
+                chan.modified.clear()
+            return cache, channels
+        runner.measure("fetch.revalidate", fetch, setup=lambda: unstamped_channels(warm),
+                       ops=listings, extra=server_counts)
+        cache_first = new_cache(cache_first=True)
+        fetch(fresh_channels(cache_first))
+        channels = runner.measure("fetch.cache_first", fetch, setup=lambda: fresh_channels(cache_first),
+                                  ops=listings, extra=server_counts)
+
+        start = align_time(datetime.now())
+        end = start + timedelta(0, args.hours*60*60)
+        n = 100
+        def listings_window(state):
+            for i in range(n):
+                get_program_listings(channels, start, end)
+        runner.measure("get_program_listings", listings_window, ops=n)
+
+        # the fast path for full timestamps, against the general parser
+        stamps = ["{} +1000".format((start + timedelta(0, i*5*60)).strftime("%Y%m%d%H%M%S")) for i in range(10000)]
+        def parse_stamps(parse):
+            return lambda state: [parse(ts, ignore_timezone=True) for ts in stamps]
+        runner.measure("parse_timestamp", parse_stamps(TVProgram.parseTimestamp), ops=len(stamps))
+        runner.measure("parse_timestamp.partial", parse_stamps(TVProgram.parsePartialTimestamp), ops=len(stamps))
+
+        shown = channels[:args.rows]
+        out = io.StringIO()
+        def epg_print(state):
+            out.seek(0)
+            out.truncate()
+            with redirect_stdout(out):
+                for i in range(10):
+                    print_epg(shown, start, end)
+        runner.measure("print_epg", epg_print, ops=10,
+                       extra=lambda: { "bytes_per_frame": len(out.getvalue()) // 10 })
+
+        # a session of arrow keys, then jumps a day each way
+        keys = ((EPG.RIGHT[0],) * 8 + (EPG.DOWN[0],) * 8 + (EPG.LEFT[0],) * 8 + (EPG.UP[0],) * 8
+                + ("\r", "n", "p", "r"))
+        epgs = []
+        def new_epg():
+            with redirect_stdout(io.StringIO()):
+                epg = EPG(shown, start, end, cache_first, jobs=args.jobs, prefetch=False)
+            epgs.append(epg)
+            return epg
+        def navigate(epg):
+            with redirect_stdout(io.StringIO()):
+                for key in keys:
+                    epg._epg_listener(key)
+        runner.measure("epg.keys", navigate, setup=new_epg, ops=len(keys),
+                       extra=lambda: dict(epgs[-1].stats(), bytes_per_frame=epgs[-1].screen.stats()["bytes_per_frame"]))
+        return runner.results
+    finally:
+        server.stop()
+
+def compare(results, baseline):
+    before = { result["name"]: result for result in baseline["results"] }
+    lines = []
+    for result in results:
+        old = before.get(result["name"])
+        if old is None:
+            lines.append("{:<24} {:>10.3f} ms".format(result["name"], result["median_ms"]))
+            continue
+        change = (result["median_ms"] - old["median_ms"]) / old["median_ms"] * 100 if old["median_ms"] else 0
+        lines.append("{:<24} {:>10.3f} ms {:>10.3f} ms {:>+8.1f}%".format(
+            result["name"], old["median_ms"], result["median_ms"], change))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark quick-xmltv against a synthetic feed.")
+    parser.add_argument("--channels", default=40, type=int)
+    parser.add_argument("--days", default=3, type=int)
+    parser.add_argument("--programs", default=48, type=int, help="Programs per channel per day.")
+    parser.add_argument("--latency", default=0.005, type=float, help="Seconds the feed server waits before each response.")
+    parser.add_argument("-j", "--jobs", default=8, type=int)
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument("--hours", default=2, type=float, help="The length of the EPG window.")
+    parser.add_argument("--columns", default=160, type=int, help="The terminal width to draw the EPG at.")
+    parser.add_argument("--rows", default=40, type=int, help="The number of channels to draw in the EPG.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--compare", help="Compare the results with those in this JSON file.")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    # the EPG is drawn at the size of the terminal
+    os.environ["COLUMNS"] = str(args.columns)
+    os.environ["LINES"] = str(args.rows + 10)
+
+    workdir = tempfile.mkdtemp(prefix="quick-xmltv-bench-")
+    try:
+        results = run(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": { key: getattr(args, key) for key in ("channels", "days", "programs", "latency", "jobs",
+                                                       "hours", "columns", "rows") },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        print("Compared with {} ({}):".format(args.compare, baseline.get("commit")))
+        for line in compare(results, baseline):
+            print(line)
+    elif args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for result in results:
+            extra = ", ".join("{}={}".format(key, value) for key, value in result.items()
+                              if key not in ("name", "runs", "ops", "min_ms", "median_ms", "mean_ms", "max_ms", "per_op_ms"))
+            print("{:<24} {:>10.3f} ms (min {:.3f}, {:.4f} ms/op){}".format(
+                result["name"], result["median_ms"], result["min_ms"], result["per_op_ms"],
+                "  " + extra if extra else ""))
+
+if __name__ == "__main__":
+    main()
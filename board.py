@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+import sys
+import shutil
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from util import *
+from xmltv import to_seconds, from_seconds
+
+class StringTable:
+    """Stores each distinct string once, handing out an index for it."""
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+        self._lock = threading.Lock()
+
+    def add(self, s):
+        id = self.ids.get(s)
+        if id is None:
+            with self._lock:
+                id = self.ids.get(s)
+                if id is None:
+                    id = len(self.strings)
+                    self.strings.append(s)
+                    self.ids[s] = id
+        return id
+
+    def __getitem__(self, id):
+        return self.strings[id]
+
+    def __len__(self):
+        return len(self.strings)
+
+class ProgramColumns:
+    """The start and end times and titles of a channel's programs.
+
+        Each is kept in an array (the titles as indexes into a shared
+        StringTable) sorted by start time, rather than as TVProgram objects.
+    """
+    def __init__(self, strings):
+        self.strings = strings
+        self.starts = array("q")
+        self.ends = array("q")
+        self.titles = array("l")
+
+    def add(self, programs):
+        if not programs:
+            return
+        rows = list(zip(self.starts, self.ends, self.titles))
+        rows += [(to_seconds(p.start), to_seconds(p.end), self.strings.add(p.title)) for p in programs]
+        rows.sort()
+        self.starts = array("q", [row[0] for row in rows])
+        self.ends = array("q", [row[1] for row in rows])
+        self.titles = array("l", [row[2] for row in rows])
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Returns the row of the program on at t (or None), and of the one
+    # after it (or None).
+    def now_next(self, t):
+        i = bisect_right(self.starts, t)
+        now = i - 1 if i > 0 and self.ends[i - 1] > t else None
+        return now, (i if i < len(self.starts) else None)
+
+    def row(self, i):
+        return from_seconds(self.starts[i]), from_seconds(self.ends[i]), self.strings[self.titles[i]]
+
+class NowNextBoard:
+    """What is on, and on next, across a set of channels.
+
+        Only the day of the given time is loaded for each channel, and the
+        day before when that listing starts later (listings usually start
+        in the early morning).
+    """
+    def __init__(self, channels, cache, jobs=8):
+        self.channels = list(channels)
+        self.cache = cache
+        self.jobs = jobs
+        self.strings = StringTable()
+        self.columns = {}
+
+    def _load(self, chan, at):
+        columns = ProgramColumns(self.strings)
+        t = to_seconds(at)
+        for d in (at.date(), at.date() - timedelta(1)):
+            if len(chan.dates) == 0 or d.isoformat() in chan.dates:
+                columns.add(chan.load(d, self.cache))
+            if len(columns) and columns.starts[0] <= t:
+                break
+        return chan.id, columns
+
+    def load(self, at):
+        pool = ThreadPoolExecutor(max_workers=max(self.jobs, 1))
+        try:
+            for id, columns in pool.map(lambda chan: self._load(chan, at), self.channels):
+                self.columns[id] = columns
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    # Returns (channel, now, next) for each channel, where now and next
+    # are (start, end, title) tuples or None.
+    def query(self, at):
+        t = to_seconds(at)
+        rows = []
+        for chan in self.channels:
+            columns = self.columns.get(chan.id)
+            if columns is None:
+                rows.append((chan, None, None))
+                continue
+            now, next = columns.now_next(t)
+            rows.append((chan,
+                         columns.row(now) if now is not None else None,
+                         columns.row(next) if next is not None else None))
+        return rows
+
+    # Returns the lines of the board; the header is only styled when
+    # styled is set (when writing to a terminal).
+    def render(self, at, columns=None, styled=True):
+        if columns is None:
+            columns, rows = shutil.get_terminal_size((80, 24))
+        results = self.query(at)
+        id_len = max([len(chan.id) for chan, now, next in results] + [len("Channel")])
+        width = max((columns - id_len - 3) // 2, 12)
+
+        def cell(prog):
+            if prog is None:
+                return "-".ljust(width)
+            text = "{} {}".format(prog[0].strftime("%H:%M"), prog[2])
+            return text[:width].ljust(width)
+
+        header = "{} {} {}".format("Channel".rjust(id_len), "Now".ljust(width), "Next".ljust(width)).rstrip()
+        lines = [ansi.BWHITE + header + ansi.RESET if styled else header]
+        for chan, now, next in results:
+            lines.append("{} {} {}".format(chan.id.rjust(id_len), cell(now), cell(next)).rstrip())
+        return lines
+
+# Prints what is on, and on next, at the given time across the channels.
+def print_board(channels, cache, at=None, jobs=8, out=sys.stdout):
+    at = at or datetime.now()
+    board = NowNextBoard(channels, cache, jobs=jobs)
+    board.load(at)
+    print(at.strftime("On at %H:%M, %A %d %B %Y"), file=out)
+    for line in board.render(at, styled=out.isatty()):
+        print(line, file=out)
+    return board
@@ -5,17 +5,463 @@
 """Standardised, platform-independent, adaptable caching made for web resources.
 """
 
+import io
 import os
 import sys
 import json
+import time
+import base64
 import appdirs
+import sqlite3
 import hashlib
+import tempfile
+import threading
+import http.client
+import urllib.request
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 from urllib.error import HTTPError
-from urllib.request import Request, urlopen
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlsplit, unquote
 
-__version_info__ = (1, 1, 0)
+__version_info__ = (1, 2, 0)
 __version__ = ".".join(map(str, __version_info__))
 
+class PooledResponse:
+    """A response read from a pooled connection.
+
+        Wraps an http.client.HTTPResponse; once the body has been read in
+        full and the response is closed, the connection is handed back to
+        the pool for reuse.
+    """
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, *args):
+        return self.response.read(*args)
+
+    def readinto(self, b):
+        return self.response.readinto(b)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+class EntryLock:
+    """An advisory lock on a cache entry, shared between threads and processes.
+
+        Entries are spread over a fixed number of lock files (named by the
+        first characters of their key) so that lock files never need to be
+        cleaned up. Uses flock() where available, and msvcrt.locking()
+        on Windows.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+
+    def acquire(self, blocking=True):
+        fp = open(self.path, "a+b")
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fp.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    fp.close()
+                    return False
+            elif msvcrt is not None:
+                while True:
+                    try:
+                        fp.seek(0)
+                        msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            fp.close()
+                            return False
+                        time.sleep(0.05)
+        except:
+            fp.close()
+            raise
+        self.fp = fp
+        return True
+
+    def release(self):
+        fp, self.fp = self.fp, None
+        if fp is None:
+            return
+        if fcntl is None and msvcrt is not None:
+            fp.seek(0)
+            msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+        fp.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+class CacheStream(io.RawIOBase):
+    """A readable stream over a resource returned by Cache.fetch_stream.
+
+        Resources served from the cache are read from disk. Downloaded
+        resources are read from the response as it arrives; each chunk is
+        hashed and written to a temporary file, which is committed to the
+        cache once the whole response has been read. Closing the stream
+        early discards the download.
+
+        manifest: The manifest of the resource. 
+        from_cache: Whether the content comes from the cache. 
+        sha1sum: The SHA-1 of the content; for downloads, only known once 
+            the stream has been read to the end.
+
+        lock, if given, is an EntryLock held for the entry, which is 
+        released once the stream is closed.
+    """
+    def __init__(self, source, manifest, sink=None, on_complete=None, lock=None):
+        self.source = source
+        self.manifest = manifest
+        self.from_cache = on_complete is None
+        self.sha1sum = manifest.get("sha1sum") if self.from_cache else None
+        self.complete = self.from_cache
+        self._sink = sink
+        self._on_complete = on_complete
+        self._hash = None if self.from_cache else hashlib.sha1()
+        self._lock = lock
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.source.readinto(b)
+        if self.complete:
+            return n
+        if n:
+            chunk = memoryview(b)[:n]
+            self._hash.update(chunk)
+            if self._sink is not None:
+                self._sink.write(chunk)
+        else:
+            self.sha1sum = self._hash.hexdigest()
+            self.complete = True
+            if self._sink is not None:
+                self._sink.close()
+            self._on_complete(self)
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.source.close()
+            if self._sink is not None and not self.complete:
+                self._sink.close()
+                os.remove(self._sink.name)
+        finally:
+            if self._lock is not None:
+                self._lock.release()
+            super().close()
+
+class RateLimiter:
+    """Spaces out requests so that each host receives at most `rate` per second.
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = {}
+        self._lock = threading.Lock()
+
+    # Blocks until another request may be sent to the given host.
+    def wait(self, host):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next.get(host, 0))
+            self._next[host] = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+class ConnectionPool:
+    """Keeps persistent HTTP/1.1 connections open for reuse between requests.
+
+        size: The maximum number of idle connections kept for each host.
+        idle_timeout: Idle connections older than this (in seconds) are
+            closed instead of being reused.
+        timeout: The socket timeout for new connections.
+        limiter: A RateLimiter each request waits on, if given.
+        proxies: A mapping of scheme to proxy URL, as given by
+            urllib.request.getproxies() (the default). Plain HTTP requests
+            are sent to the proxy with absolute URLs; HTTPS requests are
+            tunnelled through it with CONNECT. Hosts matched by no_proxy
+            are connected to directly.
+    """
+    MAX_REDIRECTS = 5
+
+    def __init__(self, size=4, idle_timeout=30, timeout=60, limiter=None, proxies=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.limiter = limiter
+        self.proxies = proxies if proxies is not None else urllib.request.getproxies()
+        self.connections = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    # Takes an idle connection to the given (scheme, host, port), or opens
+    # a new one. Returns the connection and whether it was reused.
+    def acquire(self, key):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self.connect(key), False
+
+    # Opens a new connection to the given (scheme, host, port), through
+    # the proxy for its scheme if there is one.
+    def connect(self, key):
+        with self._lock:
+            self.connections += 1
+        scheme, host, port = key
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        proxy = self.proxy(key)
+        if proxy is None:
+            return cls(host, port, timeout=self.timeout)
+
+        proxy_host, proxy_port, auth = proxy
+        conn = cls(proxy_host, proxy_port, timeout=self.timeout)
+        if scheme == "https":
+            conn.set_tunnel(host, port, headers=auth)
+        return conn
+
+    # Returns (host, port, headers) of the proxy to use for the given
+    # (scheme, host, port), or None to connect directly.
+    def proxy(self, key):
+        scheme, host, port = key
+        url = self.proxies.get(scheme)
+        if not url or urllib.request.proxy_bypass(host):
+            return None
+        if "://" not in url:
+            url = "http://" + url
+        parts = urlsplit(url)
+        auth = {}
+        if parts.username is not None:
+            credentials = "{}:{}".format(unquote(parts.username), unquote(parts.password or ""))
+            auth["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode("ascii")
+        return parts.hostname, parts.port or 80, auth
+
+    # Closes the idle connections to the given (scheme, host, port).
+    def discard(self, key):
+        with self._lock:
+            idle = self._idle.pop(key, [])
+        for conn, _ in idle:
+            conn.close()
+
+    # Returns a connection to the pool once its response has been read.
+    def release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    # Closes every idle connection.
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self._idle.clear()
+
+    # Sends a GET request for url, following redirects. Returns a
+    # PooledResponse, or raises HTTPError for error statuses.
+    def request(self, url, headers={}):
+        for _ in range(self.MAX_REDIRECTS + 1):
+            res = self._request(url, headers)
+            if res.status in (301, 302, 303, 307, 308) and res.getheader("Location"):
+                res.read()
+                res.close()
+                url = urljoin(url, res.getheader("Location"))
+                continue
+            if res.status >= 400:
+                body = res.read()
+                res.close()
+                raise HTTPError(url, res.status, res.reason, res.headers, io.BytesIO(body))
+            return res
+
+        raise HTTPError(url, res.status, "Too many redirects", res.headers, None)
+
+    def _request(self, url, headers):
+        parts = urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        proxy = self.proxy(key)
+        if proxy is not None and scheme != "https":
+            # a plain HTTP proxy is sent the whole URL
+            path = "{}://{}:{}{}".format(scheme, parts.hostname, port, path)
+            headers = dict(headers, **proxy[2])
+        if self.limiter is not None:
+            self.limiter.wait(parts.hostname)
+
+        conn, reused = self.acquire(key)
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            conn.close()
+            if not reused:
+                raise
+            # the server dropped the idle connection, and has likely dropped
+            # the others kept for it as well; retry on a new one
+            self.discard(key)
+            conn = self.connect(key)
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+        return PooledResponse(self, key, conn, response)
+
+# Returns the calling thread's connection (kept in local, a
+# threading.local) to the SQLite database at path, opening it in WAL mode
+# the first time.
+def local_db(local, path, row_factory=None):
+    db = getattr(local, "db", None)
+    if db is None:
+        db = sqlite3.connect(path, timeout=30)
+        if row_factory is not None:
+            db.row_factory = row_factory
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        local.db = db
+    return db
+
+class CacheIndex:
+    """A SQLite index of the entries in a cache directory.
+
+        Records each entry's manifest, payload size, the extensions and 
+        total size of any auxiliary files stored with it, its last access 
+        time and the time it stops being fresh. Entries are keyed by the 
+        SHA-1 of their unique ID/URL. Each thread uses its own connection.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key         TEXT PRIMARY KEY,
+            url         TEXT,
+            size        INTEGER NOT NULL DEFAULT 0,
+            aux         TEXT NOT NULL DEFAULT '',
+            aux_size    INTEGER NOT NULL DEFAULT 0,
+            last_access REAL NOT NULL DEFAULT 0,
+            fresh_until REAL,
+            manifest    TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.db.executescript(self.SCHEMA)
+
+    @property
+    def db(self):
+        return local_db(self._local, self.path, sqlite3.Row)
+
+    def get(self, key):
+        row = self.db.execute("SELECT * FROM entries WHERE key = ?", (key,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def put(self, key, url, size, manifest, fresh_until=None):
+        with self.db as db:
+            db.execute("""INSERT INTO entries (key, url, size, last_access, fresh_until, manifest)
+                          VALUES (?, ?, ?, ?, ?, ?)
+                          ON CONFLICT (key) DO UPDATE SET url = excluded.url, size = excluded.size,
+                              last_access = excluded.last_access, fresh_until = excluded.fresh_until,
+                              manifest = excluded.manifest""",
+                       (key, url, size, time.time(), fresh_until, json.dumps(manifest)))
+
+    def set_manifest(self, key, manifest, fresh_until=None):
+        with self.db as db:
+            db.execute("UPDATE entries SET manifest = ?, fresh_until = ?, last_access = ? WHERE key = ?",
+                       (json.dumps(manifest), fresh_until, time.time(), key))
+
+    def add_aux(self, key, ext, size_change):
+        row = self.get(key)
+        if row is None:
+            return False
+        exts = set(filter(None, row["aux"].split(",")))
+        exts.add(ext)
+        with self.db as db:
+            db.execute("UPDATE entries SET aux = ?, aux_size = MAX(aux_size + ?, 0) WHERE key = ?",
+                       (",".join(sorted(exts)), size_change, key))
+        return True
+
+    def touch(self, key):
+        with self.db as db:
+            db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+
+    def remove(self, key):
+        with self.db as db:
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    # Returns the number of entries and their total size, in bytes.
+    def totals(self):
+        row = self.db.execute("SELECT COUNT(*), TOTAL(size + aux_size) FROM entries").fetchone()
+        return row[0], int(row[1])
+
+    def count_fresh(self, now=None):
+        now = now if now is not None else time.time()
+        return self.db.execute("SELECT COUNT(*) FROM entries WHERE fresh_until > ?", (now,)).fetchone()[0]
+
+    # Returns (url, manifest) for each entry with an auxiliary file of the
+    # given extension.
+    def with_aux(self, ext):
+        rows = self.db.execute("SELECT url, manifest FROM entries WHERE ',' || aux || ',' LIKE ?",
+                               ("%," + ext + ",%",))
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    # Returns up to `limit` entries, least recently used first.
+    def lru(self, limit):
+        rows = self.db.execute("SELECT * FROM entries ORDER BY last_access LIMIT ?", (limit,))
+        return [dict(row) for row in rows]
+
 class Cache:
     """An app-specific cache manager.
 
@@ -24,9 +470,35 @@ class Cache:
             it does not exist.
         user_agent: The user agent to be used when making web requests. 
             Defaults to 'python-ecache/1.0'.
+        pool_size: The number of persistent connections kept open to each 
+            host. Defaults to 4.
+        idle_timeout: The number of seconds an unused connection is kept 
+            open for. Defaults to 30.
+        heuristic_max_age: The number of seconds a resource without any 
+            freshness information or validators stays fresh for. 
+            Defaults to 300.
+        heuristic_fraction: The fraction of the time since a resource was 
+            last modified that it stays fresh for, if the server does not 
+            say otherwise. Defaults to 0.1.
+        max_bytes: The total size the cache is kept under by evicting the 
+            least recently used entries. Defaults to no limit.
+        max_entries: The number of entries the cache is kept under by 
+            evicting the least recently used ones. Defaults to no limit.
+        rate_limit: The most requests sent to each host per second. 
+            Defaults to no limit.
     """
+    INDEX_NAME = "index.sqlite"
+    LOCKS_DIR = "locks"
+    # the number of key characters naming each entry's lock file
+    LOCK_PREFIX = 3
+    # the most entries evicted after saving a single resource
+    EVICT_BATCH = 16
+
     def __init__(self, cache_dir=appdirs.user_cache_dir("python-ecache", "bell345"), 
-                       user_agent="python-ecache/1.0", verbose=False, cache_first=False):
+                       user_agent="python-ecache/1.0", verbose=False, cache_first=False,
+                       pool_size=4, idle_timeout=30, heuristic_max_age=300,
+                       heuristic_fraction=0.1, max_bytes=None, max_entries=None,
+                       rate_limit=None):
 
         if isinstance(cache_dir, tuple):
             cache_dir = appdirs.user_cache_dir(*cache_dir)
@@ -35,12 +507,51 @@ class Cache:
         self.user_agent = user_agent
         self.verbose = verbose
         self.cache_first = cache_first
+        self.pool = ConnectionPool(pool_size, idle_timeout,
+                                   limiter=RateLimiter(rate_limit) if rate_limit else None)
+        self.heuristic_max_age = heuristic_max_age
+        self.heuristic_fraction = heuristic_fraction
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
         if not os.path.isdir(self.cache_dir):
-            os.makedirs(self.cache_dir)
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.index = CacheIndex(os.path.join(self.cache_dir, self.INDEX_NAME))
+        os.makedirs(os.path.join(self.cache_dir, self.LOCKS_DIR), exist_ok=True)
+
+        self.counters = { "hits": 0, "unchanged": 0, "revalidated": 0, "downloads": 0,
+                          "bytes_downloaded": 0, "evictions": 0, "coalesced": 0 }
+        self._counters_lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._counters_lock:
+            self.counters[name] += n
+
+    # Retrieves the index key for a resource with a given unique ID/URL.
+    def get_key(self, id):
+        return hashlib.sha1(id.encode()).hexdigest()
+
+    # Retrieves the lock guarding the entry with the given index key.
+    def get_lock(self, key):
+        return EntryLock(os.path.join(self.cache_dir, self.LOCKS_DIR,
+                                      key[:self.LOCK_PREFIX] + ".lock"))
+
+    # Writes content to path through a temporary file in the same
+    # directory, so that readers never see a partially written file.
+    def write_atomic(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                prefix=os.path.basename(path) + ".", suffix=".tmp", delete=False) as fp:
+            try:
+                fp.write(content)
+            except:
+                fp.close()
+                os.remove(fp.name)
+                raise
+        os.replace(fp.name, path)
 
     # Retrieves the file path for a resource with a given unique ID/URL.
     def get_cache_path(self, id):
-        hash = hashlib.sha1(id.encode()).hexdigest()
+        hash = self.get_key(id)
         return os.path.join(self.cache_dir, hash[0], hash)
 
     # Opens the cached file location given a unique ID/URL for reading/writing.
@@ -49,95 +560,373 @@ class Cache:
     def open(self, id, *args, **kwargs):
         cache_path = self.get_cache_path(id)
         if not os.path.isdir(os.path.dirname(cache_path)):
-            os.makedirs(os.path.dirname(cache_path))
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
         return open(cache_path, *args, **kwargs)
 
     # Opens the manifest associated with the cached file location given a
     # unique ID/URL for reading/writing.
     # Supports the same options as open(), but with a unique ID/URL
     # instead of a filename.
+    # Manifests are now kept in the index; these files are only read to
+    # import entries cached by older versions.
     def open_mf(self, id, *args, **kwargs):
         mf_path = self.get_cache_path(id) + ".json"
         if not os.path.isdir(os.path.dirname(mf_path)):
-            os.makedirs(os.path.dirname(mf_path))
+            os.makedirs(os.path.dirname(mf_path), exist_ok=True)
         return open(mf_path, *args, **kwargs)
 
+    # Opens a file stored alongside the cached resource with the given
+    # unique ID/URL, distinguished by a file extension.
+    # Supports the same options as open(), but with a unique ID/URL
+    # and extension instead of a filename.
+    def open_aux(self, id, ext, *args, **kwargs):
+        aux_path = self.get_cache_path(id) + "." + ext
+        if not os.path.isdir(os.path.dirname(aux_path)):
+            os.makedirs(os.path.dirname(aux_path), exist_ok=True)
+        return open(aux_path, *args, **kwargs)
+
+    # Saves a file alongside the cached resource with the given unique
+    # ID/URL, so that it is accounted for and evicted together with it.
+    # Does not take the entry's lock, so it may be called while reading a
+    # stream of the resource.
+    def save_aux(self, id, ext, content):
+        aux_path = self.get_cache_path(id) + "." + ext
+        try:
+            old_size = os.path.getsize(aux_path)
+        except OSError:
+            old_size = 0
+        self.write_atomic(aux_path, content)
+        if not self.index.add_aux(self.get_key(id), ext, len(content) - old_size):
+            # the resource itself is not cached (or was just evicted)
+            os.remove(aux_path)
+            return
+        self.evict(self.EVICT_BATCH)
+
+    # Retrieves the index entry for a resource given a unique ID/URL,
+    # importing it from its manifest file if it was cached by an older
+    # version. Returns None if the resource is not cached.
+    def get_entry(self, id):
+        key = self.get_key(id)
+        entry = self.index.get(key)
+        if entry is not None:
+            entry["manifest"] = json.loads(entry["manifest"])
+            return entry
+
+        try:
+            with self.open_mf(id) as mf:
+                manifest = json.load(mf)
+            size = os.path.getsize(self.get_cache_path(id))
+        except (OSError, ValueError):
+            return None
+        self.index.put(key, id, size, manifest)
+        os.remove(self.get_cache_path(id) + ".json")
+        return self.get_entry(id)
+
+    # Retrieves the manifest for a resource given a unique ID/URL, or an
+    # empty manifest if there is none.
+    def get_manifest(self, id):
+        entry = self.get_entry(id)
+        return entry["manifest"] if entry is not None else {}
+
     # Retrieves a resource from the cache given a unique ID/URL.
     def get(self, id):
-        if self.verbose: print("Retrieving cache resource: " + id)
+        if self.verbose: print("Retrieving cache resource: " + id, file=sys.stderr)
         with self.open(id, "rb") as fp:
-            return fp.read()
+            content = fp.read()
+        self.index.touch(self.get_key(id))
+        return content
 
     # Saves a resource to the cache given a unique ID/URL and the
     # content to be saved.
-    def save(self, id, content):
-        if self.verbose: print("Saving cache resource: " + id)
-        with self.open(id, "wb") as fp:
-            fp.write(content)
+    def save(self, id, content, manifest=None):
+        if self.verbose: print("Saving cache resource: " + id, file=sys.stderr)
+        key = self.get_key(id)
+        with self.get_lock(key):
+            self.write_atomic(self.get_cache_path(id), content)
+            if manifest is None:
+                manifest = self.get_manifest(id)
+            self.index.put(key, id, len(content), manifest)
+        self.evict(self.EVICT_BATCH)
 
     # Removes a resource from the cache given a unique ID/URL.
     def remove(self, id):
-        path = self.get_cache_path(id)
-        os.remove(path)
+        key = self.get_key(id)
+        with self.get_lock(key):
+            self.remove_entry(key)
+
+    # Removes a resource and any files stored with it given its index key.
+    # The caller must hold the entry's lock.
+    def remove_entry(self, key, entry=None):
+        entry = entry or self.index.get(key)
+        path = os.path.join(self.cache_dir, key[0], key)
+        exts = [""] + [ "." + ext for ext in entry["aux"].split(",") if ext ] if entry else [""]
+        for ext in exts:
+            try:
+                os.remove(path + ext)
+            except FileNotFoundError:
+                pass
+        self.index.remove(key)
+
+    # Evicts the least recently used entries until the cache is within
+    # its budget, removing at most `limit` entries (if given).
+    def evict(self, limit=None):
+        if self.max_bytes is None and self.max_entries is None:
+            return 0
+
+        entries, size = self.index.totals()
+        over = lambda: (self.max_bytes is not None and size > self.max_bytes) or \
+                       (self.max_entries is not None and entries > self.max_entries)
+        evicted = skipped = 0
+        while over() and (limit is None or evicted < limit):
+            batch = self.index.lru(skipped + (min(limit - evicted, self.EVICT_BATCH) if limit else self.EVICT_BATCH))
+            batch = batch[skipped:]
+            if not batch:
+                break
+            for entry in batch:
+                if not over() or (limit is not None and evicted >= limit):
+                    break
+                # entries in use (by this or another process) are left alone
+                lock = self.get_lock(entry["key"])
+                if not lock.acquire(blocking=False):
+                    skipped += 1
+                    continue
+                try:
+                    if self.verbose: print("Evicting cache resource: " + (entry["url"] or entry["key"]), file=sys.stderr)
+                    self.remove_entry(entry["key"], entry)
+                finally:
+                    lock.release()
+                entries -= 1
+                size -= entry["size"] + entry["aux_size"]
+                evicted += 1
+
+        self.count("evictions", evicted)
+        return evicted
+
+    # Returns statistics about the contents and use of the cache.
+    def stats(self):
+        entries, size = self.index.totals()
+        stats = { "entries": entries, "bytes": size, "fresh": self.index.count_fresh(),
+                  "max_entries": self.max_entries, "max_bytes": self.max_bytes }
+        with self._counters_lock:
+            stats.update(self.counters)
+        return stats
+
+    # Parses a Cache-Control header into a dict of its directives.
+    @staticmethod
+    def parse_cache_control(value):
+        directives = {}
+        for part in (value or "").split(","):
+            name, _, arg = part.strip().partition("=")
+            if name:
+                directives[name.lower()] = arg.strip('"') if arg else True
+        return directives
+
+    # Parses an HTTP date into a POSIX timestamp, or returns None.
+    @staticmethod
+    def parse_http_date(value):
+        try:
+            return parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    # Records the freshness information of a response in a manifest.
+    def update_freshness(self, manifest, res):
+        for key in ("date", "expires", "max-age", "age", "no-cache"):
+            manifest.pop(key, None)
+        manifest["fetched"] = time.time()
+
+        cc = Cache.parse_cache_control(res.getheader("Cache-Control"))
+        if "no-cache" in cc:
+            manifest["no-cache"] = True
+        for directive in ("s-maxage", "max-age"):
+            if directive in cc:
+                try:
+                    manifest["max-age"] = int(cc[directive])
+                    break
+                except ValueError:
+                    pass
+        for header in ("Date", "Expires", "Age"):
+            if res.getheader(header):
+                manifest[header.lower()] = res.getheader(header)
+        return cc
+
+    # Returns the number of seconds a cached resource stays fresh for,
+    # following RFC 7234: max-age, then Expires, then a heuristic based on
+    # Last-Modified (or heuristic_max_age if there are no validators).
+    def freshness_lifetime(self, manifest):
+        if manifest.get("no-cache"):
+            return 0
+        if "max-age" in manifest:
+            return manifest["max-age"]
+
+        date = Cache.parse_http_date(manifest.get("date")) or manifest.get("fetched", 0)
+        if "expires" in manifest:
+            expires = Cache.parse_http_date(manifest["expires"])
+            return max(expires - date, 0) if expires is not None else 0
+        if "last-modified" in manifest:
+            modified = Cache.parse_http_date(manifest["last-modified"])
+            if modified is not None:
+                return max(date - modified, 0) * self.heuristic_fraction
+        if "etag" in manifest:
+            return 0
+        return self.heuristic_max_age
+
+    # Returns whether a cached resource can be used without revalidation.
+    # max_age, if given, overrides the lifetime given by the server.
+    def is_fresh(self, manifest, max_age=None):
+        if "fetched" not in manifest:
+            return False
+        try:
+            age = int(manifest.get("age", 0))
+        except ValueError:
+            age = 0
+        age += time.time() - manifest["fetched"]
+        lifetime = max_age if max_age is not None else self.freshness_lifetime(manifest)
+        return age < lifetime
 
     # Fetches a remote resource using the given URL.
     # If a fresh copy is available in the cache, it is returned instead
     # of the remote resource.
     # Utilises the ETag/If-None-Match, Last-Modified/If-Modified-Since
     # and Cache-Control HTTP headers.
-    def fetch(self, url, cache_first=None):
+    # max_age overrides how long (in seconds) the cached copy is
+    # considered fresh for; use 0 to always revalidate.
+    # version is an opaque version of the resource known from elsewhere
+    # (such as a modification stamp in an index of resources); a cached
+    # copy saved under the same version is used without any request.
+    def fetch(self, url, cache_first=None, max_age=None, version=None):
+        with self.fetch_stream(url, cache_first, max_age, version) as fp:
+            return fp.read()
+
+    # Like fetch(), but returns a CacheStream over the resource instead of
+    # its content. A downloaded resource is saved to the cache as it is
+    # read, and committed once the stream has been read to the end.
+    def fetch_stream(self, url, cache_first=None, max_age=None, version=None):
         if cache_first is None:
             cache_first = self.cache_first
 
         if not os.path.isdir(self.cache_dir):
-            os.makedirs(self.cache_dir)
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Only one thread or process fetches an entry at a time; the lock is
+        # held until a download has been committed, so concurrent fetches
+        # of the same URL wait for it and then use the cached copy.
+        key = self.get_key(url)
+        lock = self.get_lock(key)
+        requested = time.time()
+        lock.acquire()
+        try:
+            stream = self._fetch_stream(url, key, lock, cache_first, max_age, version, requested)
+        except:
+            lock.release()
+            raise
+        if stream.from_cache:
+            lock.release()
+        return stream
 
+    def _fetch_stream(self, url, key, lock, cache_first, max_age, version, requested):
         cache_path = self.get_cache_path(url)
-        cache_mf = cache_path + ".json"
-        manifest = {}
+        entry = self.get_entry(url)
+        manifest = entry["manifest"] if entry is not None else {}
 
-        req = Request(url)
-        req.add_header("User-Agent", self.user_agent)
-
-        if os.path.isfile(cache_path) and os.path.isfile(cache_mf):
-            with self.open_mf(url) as mf:
-                try:
-                    manifest = json.load(mf)
-                except:
-                    pass
+        headers = { "User-Agent": self.user_agent }
 
+        if entry is not None:
             if "etag" in manifest:
-                req.add_header("If-None-Match",
-                    manifest["etag"])
+                headers["If-None-Match"] = manifest["etag"]
             if "last-modified" in manifest:
-                req.add_header("If-Modified-Since",
-                    manifest["last-modified"])
+                headers["If-Modified-Since"] = manifest["last-modified"]
 
-        if cache_first and os.path.isfile(cache_path):
-            return self.get(url)
-        else:
-            try:
-                res = urlopen(req)
-            except:
-                if os.path.isfile(cache_path):
-                    return self.get(url)
-                else:
-                    print("Could not load cache URL {}.".format(url))
-                raise
+            # fetched by someone else while we were waiting for the lock
+            coalesced = manifest.get("fetched", 0) >= requested
+            unchanged = version is not None and manifest.get("version") == version
+            if cache_first or coalesced or unchanged or self.is_fresh(manifest, max_age):
+                stream = self.open_cached(url, manifest)
+                if stream is not None:
+                    self.count("coalesced" if coalesced else "unchanged" if unchanged else "hits")
+                    return stream
+                entry = None
+                headers.pop("If-None-Match", None)
+                headers.pop("If-Modified-Since", None)
+
+        try:
+            res = self.pool.request(url, headers)
+        except:
+            stream = self.open_cached(url, manifest) if entry is not None else None
+            if stream is not None:
+                return stream
+            if self.verbose: print("Could not load cache URL {}.".format(url), file=sys.stderr)
+            raise
+
+        cc = self.update_freshness(manifest, res)
+        if res.status == 304:
+            with res:
+                res.read()
+            if res.getheader("ETag"):
+                manifest["etag"] = res.getheader("ETag")
+            if version is not None:
+                manifest["version"] = version
+            self.index.set_manifest(key, manifest, self.fresh_until(manifest))
+            self.count("revalidated")
+            stream = self.open_cached(url, manifest)
+            if stream is not None:
+                return stream
+            # the payload went missing; download it again
+            return self._fetch_stream(url, key, lock, False, 0, version, time.time())
 
         manifest["url"] = url
-        if res.getheader("Cache-Control") != "no-cache":
+        if version is not None:
+            manifest["version"] = version
+        else:
+            manifest.pop("version", None)
+        if "no-cache" not in cc:
             if res.getheader("ETag"):
                 manifest["etag"] = res.getheader("ETag")
             if res.getheader("Last-Modified"):
                 manifest["last-modified"] = res.getheader("Last-Modified")
 
-        content = res.read()
-        manifest["sha1sum"] = hashlib.sha1(content).hexdigest()
-        with self.open_mf(url, "w") as fp:
-            json.dump(manifest, fp)
+        sink = None
+        if "no-store" not in cc:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            sink = tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_path),
+                prefix=os.path.basename(cache_path) + ".", suffix=".tmp", delete=False)
 
-        if "etag" in manifest or "last-modified" in manifest:
-            self.save(url, content)
+        # Called with the entry's lock held once the whole response has been
+        # read: the payload is moved into place and the manifest committed
+        # before any other fetcher can look at the entry.
+        def commit(stream):
+            manifest["sha1sum"] = stream.sha1sum
+            size = os.path.getsize(sink.name) if sink is not None else 0
+            self.count("downloads")
+            self.count("bytes_downloaded", size)
+            if sink is None:
+                if entry is not None:
+                    self.remove_entry(key)
+                return
+            if self.verbose: print("Saving cache resource: " + url, file=sys.stderr)
+            os.replace(sink.name, cache_path)
+            self.index.put(key, url, size, manifest, self.fresh_until(manifest))
+            self.evict(self.EVICT_BATCH)
 
-        return content
+        return CacheStream(res, manifest, sink, commit, lock)
+
+    # Returns the time a resource stops being fresh, going by its manifest.
+    def fresh_until(self, manifest):
+        try:
+            return manifest["fetched"] + self.freshness_lifetime(manifest) - int(manifest.get("age", 0))
+        except (KeyError, ValueError):
+            return None
+
+    # Opens a CacheStream over the cached copy of a resource, or returns
+    # None if its payload is missing.
+    def open_cached(self, url, manifest=None):
+        if self.verbose: print("Retrieving cache resource: " + url, file=sys.stderr)
+        if manifest is None:
+            manifest = self.get_manifest(url)
+        try:
+            fp = self.open(url, "rb")
+        except FileNotFoundError:
+            self.remove_entry(self.get_key(url))
+            return None
+        self.index.touch(self.get_key(url))
+        return CacheStream(fp, manifest)
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+import sys
+import csv
+import json
+from collections import deque
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from util import *
+
+FORMATS = ("jsonl", "csv", "json")
+
+class ListingWriter:
+    """Writes program records to a file as they arrive, in one of FORMATS."""
+    def __init__(self, fmt, out=sys.stdout):
+        self.fmt = fmt
+        self.out = out
+        self.count = 0
+        self.csv = None
+
+    def write(self, prog):
+        record = prog.to_dict()
+        if self.fmt == "jsonl":
+            self.out.write(json.dumps(record) + "\n")
+        elif self.fmt == "json":
+            self.out.write(("[\n" if self.count == 0 else ",\n") + json.dumps(record))
+        elif self.fmt == "csv":
+            if self.csv is None:
+                self.csv = csv.DictWriter(self.out, fieldnames=list(record))
+                self.csv.writeheader()
+            record["actors"] = "; ".join(record["actors"])
+            record["categories"] = "; ".join(record["categories"])
+            self.csv.writerow(record)
+        self.count += 1
+
+    def close(self):
+        if self.fmt == "json":
+            self.out.write("[]\n" if self.count == 0 else "\n]\n")
+        self.out.flush()
+
+# Returns the programs of a channel between start and end, loading the
+# listing of each day the window covers. A listing may start after
+# midnight, so the day before is loaded too when it does.
+def channel_programs(chan, cache, start, end):
+    first, last = start.date(), (end - timedelta.resolution).date()
+    days = [first + timedelta(i) for i in range((last - first).days + 1)]
+    days = [d for d in days if len(chan.dates) == 0 or d.isoformat() in chan.dates]
+
+    programs = []
+    seen = set()
+    for i, d in enumerate(days):
+        listing = chan.load(d, cache) or []
+        if i == 0 and (not listing or min(p.start for p in listing) > start):
+            prev = start.date() - timedelta(1)
+            if len(chan.dates) == 0 or prev.isoformat() in chan.dates:
+                listing = (chan.load(prev, cache) or []) + listing
+        for prog in sorted(listing, key=lambda p: p.start):
+            # adjacent listings can both hold the program spanning midnight
+            if prog.end > start and prog.start < end and prog.key() not in seen:
+                seen.add(prog.key())
+                programs.append(prog)
+    return programs
+
+# Writes the programs of each channel between start and end to out, in
+# channel order. Up to `jobs` channels are loaded at once, and each
+# channel's programs are written (and dropped) as soon as it and the
+# channels before it are loaded.
+def export(channels, cache, start, end, fmt="jsonl", jobs=8, out=sys.stdout):
+    writer = ListingWriter(fmt, out)
+    pending = deque()
+    channels = iter(channels)
+    pool = ThreadPoolExecutor(max_workers=max(jobs, 1))
+    try:
+        while True:
+            while len(pending) < max(jobs, 1) * 2:
+                chan = next(channels, None)
+                if chan is None:
+                    break
+                pending.append(pool.submit(channel_programs, chan, cache, start, end))
+            if not pending:
+                break
+            for prog in pending.popleft().result():
+                writer.write(prog)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    writer.close()
+    return writer.count
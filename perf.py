@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# Timing spans and counters for the hot paths, reported by --profile.
+#
+# Profiling is off until enable() is called. While it is off, span()
+# returns a shared do-nothing context manager and count() returns straight
+# away, so instrumented code costs a function call per span.
+#
+#     with perf.span("listing.parse"):
+#         ...
+#     perf.count("programs.parsed", len(programs))
+#
+# Spans are aggregated by name (calls, total, mean and longest time) across
+# every thread. A span's time includes that of any spans opened inside it,
+# and spans in worker threads overlap, so totals can add up to more than
+# the time elapsed.
+
+import io
+import sys
+import json
+import threading
+from time import perf_counter
+
+enabled = False
+spans = {}
+counters = {}
+# functions returning counters kept elsewhere, by prefix
+sources = {}
+_started = None
+_lock = threading.Lock()
+
+class Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        record(self.name, perf_counter() - self.start)
+        return False
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def enable():
+    global enabled, _started
+    enabled = True
+    _started = perf_counter()
+
+def span(name):
+    return Span(name) if enabled else NULL_SPAN
+
+# Adds a span of the given length (in seconds) under name.
+def record(name, seconds):
+    with _lock:
+        entry = spans.get(name)
+        if entry is None:
+            spans[name] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with _lock:
+        counters[name] = counters.get(name, 0) + n
+
+# Includes the counters returned by fn() in the report, under prefix.
+def include(prefix, fn):
+    sources[prefix] = fn
+
+class TimedReader(io.RawIOBase):
+    """A binary stream whose reads are each a span under name."""
+    def __init__(self, fp, name):
+        self.fp = fp
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        start = perf_counter()
+        n = self.fp.readinto(b)
+        record(self.name, perf_counter() - start)
+        return n
+
+# Returns fp, wrapped so that its reads are timed if profiling is enabled.
+def timed_reader(fp, name):
+    return TimedReader(fp, name) if enabled else fp
+
+# Decorates a function so that each call is a span under name.
+def timed(name):
+    def decorator(fn):
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with Span(name):
+                return fn(*args, **kwargs)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return decorator
+
+def report():
+    merged = {}
+    for prefix, fn in sources.items():
+        for name, value in fn().items():
+            merged["{}.{}".format(prefix, name)] = value
+    with _lock:
+        merged.update(counters)
+        return {
+            "elapsed_ms": round((perf_counter() - _started) * 1000, 3) if _started is not None else 0,
+            "spans": { name: { "calls": calls, "total_ms": round(total * 1000, 3),
+                               "mean_ms": round(total / calls * 1000, 4), "max_ms": round(longest * 1000, 3) }
+                       for name, (calls, total, longest) in sorted(spans.items(), key=lambda item: -item[1][1]) },
+            "counters": dict(sorted(merged.items())),
+        }
+
+def format_report(data=None):
+    data = data or report()
+    name_len = max([len(name) for name in list(data["spans"]) + list(data["counters"])] + [len("Span")])
+    lines = ["Profile ({:.1f} ms elapsed):".format(data["elapsed_ms"]),
+             "{} {:>8} {:>12} {:>10} {:>10}".format("Span".ljust(name_len), "Calls", "Total ms", "Mean ms", "Max ms")]
+    for name, s in data["spans"].items():
+        lines.append("{} {:>8} {:>12.1f} {:>10.3f} {:>10.1f}".format(
+            name.ljust(name_len), s["calls"], s["total_ms"], s["mean_ms"], s["max_ms"]))
+    if data["counters"]:
+        lines.append("")
+        lines.append("{} {:>8}".format("Counter".ljust(name_len), "Count"))
+        for name, value in data["counters"].items():
+            lines.append("{} {:>8}".format(name.ljust(name_len), value))
+    return lines
+
+# Prints the report, or writes it as JSON to the file at path ("-" for
+# standard output).
+def write_report(path=None, out=sys.stderr):
+    if path is None:
+        for line in format_report():
+            print(line, file=out)
+    elif path == "-":
+        json.dump(report(), sys.stdout, indent=2)
+        print()
+    else:
+        with open(path, "w") as fp:
+            json.dump(report(), fp, indent=2)
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+import os
+import re
+import sys
+import json
+import sqlite3
+import threading
+from datetime import date
+
+import perf
+from util import *
+from ecache import local_db
+from xmltv import TVProgram, SNAPSHOT_EXT, load_snapshot
+
+TOKEN_RE = re.compile(r"\w+")
+LISTING_RE = re.compile(r"(.+)_(\d{4}-\d{2}-\d{2})\.xml\.gz$")
+
+# Splits text into lower case search terms, leaving out single letters.
+def tokenize(text):
+    return [term for term in TOKEN_RE.findall(text.lower()) if len(term) > 1]
+
+class ProgramSearch:
+    """A full-text index of the programs of the cached listings, kept in
+        the cache directory.
+
+        Each term in a program's title, sub-title, description, actors,
+        director and categories is posted against the program, weighted by
+        the fields it appears in. Listings are indexed as they are synced,
+        or from their snapshots by catch_up(), and indexed again only when
+        their content (by SHA-1) has changed, which replaces just that
+        listing's programs. Each thread uses its own connection.
+    """
+    INDEX_NAME = "search.sqlite"
+    # programs are stored as JSON records (see TVProgram.to_record)
+    SCHEMA_VERSION = 1
+    WEIGHTS = { "title": 8, "sub_title": 4, "actors": 3, "director": 3, "categories": 2, "description": 1 }
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS listings (
+            url         TEXT PRIMARY KEY,
+            channel     TEXT NOT NULL,
+            day         TEXT NOT NULL,
+            sha1        TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS programs (
+            id          INTEGER PRIMARY KEY,
+            url         TEXT NOT NULL,
+            channel     TEXT NOT NULL,
+            start       TEXT NOT NULL,
+            record      TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS programs_url ON programs (url);
+        CREATE TABLE IF NOT EXISTS postings (
+            term        TEXT NOT NULL,
+            program     INTEGER NOT NULL,
+            weight      INTEGER NOT NULL,
+            PRIMARY KEY (term, program)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS postings_program ON postings (program);
+    """
+    def __init__(self, cache, path=None):
+        self.cache = cache
+        self.path = path or os.path.join(cache.cache_dir, self.INDEX_NAME)
+        self._local = threading.local()
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            # programs were pickled before version 1; index them again
+            self.db.executescript("DROP TABLE IF EXISTS postings; DROP TABLE IF EXISTS programs; "
+                                  "DROP TABLE IF EXISTS listings;")
+            self.db.execute("PRAGMA user_version = {}".format(self.SCHEMA_VERSION))
+        self.db.executescript(self.SCHEMA)
+
+    @property
+    def db(self):
+        return local_db(self._local, self.path)
+
+    # Returns each of a program's terms with its weight.
+    def terms(self, prog):
+        weights = {}
+        for field, weight in self.WEIGHTS.items():
+            value = getattr(prog, field)
+            if not value:
+                continue
+            if not isinstance(value, str):
+                value = " ".join(value)
+            for term in tokenize(value):
+                weights[term] = weights.get(term, 0) + weight
+        return weights
+
+    def indexed(self, url):
+        row = self.db.execute("SELECT sha1 FROM listings WHERE url = ?", (url,)).fetchone()
+        return row[0] if row is not None else None
+
+    # Indexes the programs of the listing at url, unless that version of it
+    # is already indexed. Returns whether it was indexed.
+    def update(self, url, channel, d, sha1sum, programs):
+        if not sha1sum:
+            return False
+        try:
+            if self.indexed(url) == sha1sum:
+                return False
+            with self.db as db:
+                self._remove(db, url)
+                db.execute("INSERT INTO listings (url, channel, day, sha1) VALUES (?, ?, ?, ?)",
+                           (url, channel, d.isoformat(), sha1sum))
+                # number the programs here, so each table takes one insert
+                first = db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM programs").fetchone()[0]
+                db.executemany("INSERT INTO programs (id, url, channel, start, record) VALUES (?, ?, ?, ?, ?)",
+                               [(id, url, prog.channel or channel, prog.start.isoformat(),
+                                 json.dumps(prog.to_record(), separators=(",", ":")))
+                                for id, prog in enumerate(programs, first)])
+                db.executemany("INSERT INTO postings (term, program, weight) VALUES (?, ?, ?)",
+                               [(term, id, weight) for id, prog in enumerate(programs, first)
+                                for term, weight in self.terms(prog).items()])
+            return True
+        except sqlite3.Error as e:
+            if self.cache.verbose: print("Failed to index {}: {}".format(url, e), file=sys.stderr)
+            return False
+
+    def _remove(self, db, url):
+        db.execute("DELETE FROM postings WHERE program IN (SELECT id FROM programs WHERE url = ?)", (url,))
+        db.execute("DELETE FROM programs WHERE url = ?", (url,))
+        db.execute("DELETE FROM listings WHERE url = ?", (url,))
+
+    # Brings the index up to date with the listings in the cache: indexes
+    # those parsed (and snapshotted) before the index existed or while it
+    # was not in use, and drops those evicted from the cache since. The
+    # cache index's manifests give each listing's SHA-1, so only snapshots
+    # of listings that have changed are read. Returns the number of
+    # listings indexed.
+    def catch_up(self):
+        listings = dict(self.cache.index.with_aux(SNAPSHOT_EXT))
+        indexed = dict(self.db.execute("SELECT url, sha1 FROM listings"))
+        with self.db as db:
+            for url in indexed:
+                if url not in listings:
+                    self._remove(db, url)
+
+        count = 0
+        for url, manifest in listings.items():
+            sha1sum = manifest.get("sha1sum")
+            match = LISTING_RE.match(url.rsplit("/", 1)[-1])
+            if match is None or not sha1sum or indexed.get(url) == sha1sum:
+                continue
+            programs = load_snapshot(self.cache, url, sha1sum)
+            if programs is None:
+                continue
+            count += self.update(url, match.group(1), date.fromisoformat(match.group(2)), sha1sum, programs)
+        return count
+
+    # Returns (score, program) for the programs containing every term of
+    # query, best first (then earliest). A query ending in "*" matches
+    # terms starting with its last word. Results can be limited to some
+    # channels, or to programs starting from a given time.
+    def search(self, query, limit=50, channels=None, since=None):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        prefix = query.rstrip().endswith("*")
+
+        # one table of (program, weight) per term, joined on the program,
+        # so that SQLite intersects and ranks them and only the best rows
+        # come back
+        matches, params = [], []
+        for i, term in enumerate(terms):
+            if prefix and i == len(terms) - 1:
+                matches.append("""t{} AS (SELECT program, SUM(weight) AS weight FROM postings
+                                          WHERE term >= ? AND term < ? GROUP BY program)""".format(i))
+                params += [term, term + "\uffff"]
+            else:
+                matches.append("t{} AS (SELECT program, weight FROM postings WHERE term = ?)".format(i))
+                params.append(term)
+        sql = "WITH {} SELECT {} AS score, programs.record FROM t0".format(
+            ", ".join(matches), " + ".join("t{}.weight".format(i) for i in range(len(terms))))
+        for i in range(1, len(terms)):
+            sql += " JOIN t{0} ON t{0}.program = t0.program".format(i)
+        sql += " JOIN programs ON programs.id = t0.program WHERE 1"
+        if channels:
+            sql += " AND programs.channel IN ({})".format(",".join("?" * len(channels)))
+            params += list(channels)
+        if since is not None:
+            sql += " AND programs.start >= ?"
+            params.append(since.isoformat())
+        sql += " ORDER BY score DESC, programs.start, programs.channel LIMIT ?"
+        params.append(-1 if limit is None else limit)
+
+        return [(score, TVProgram.from_record(json.loads(record)))
+                for score, record in self.db.execute(sql, params)]
+
+    def stats(self):
+        listings, programs, postings = (self.db.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]
+                                        for table in ("listings", "programs", "postings"))
+        return { "listings": listings, "programs": programs, "postings": postings }
+
+# Prints the programs matching query across the cached listings.
+def print_search(index, query, channels=None, since=None, limit=50, out=sys.stdout):
+    with perf.span("search.catch_up"):
+        index.catch_up()
+    with perf.span("search.query"):
+        results = index.search(query, limit=limit, channels=channels, since=since)
+    if not results:
+        print("No programs found.", file=out)
+        return results
+    id_len = max(len(prog.channel) for score, prog in results)
+    for score, prog in results:
+        title = prog.title + (" ({})".format(prog.sub_title) if prog.sub_title else "")
+        print("{} {}-{} {} {}".format(prog.start.strftime("%a %Y-%m-%d"), prog.start.strftime("%H:%M"),
+                                     prog.end.strftime("%H:%M"), prog.channel.ljust(id_len), title), file=out)
+    return results
@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+
+import sys
+import json
+import threading
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+from util import *
+from xmltv import ChannelDirectory, fetch_programs, parse_channels
+
+class ListingService:
+    """Keeps the listings of a set of channels in memory for queries.
+
+        The days from DAYS_BEHIND days ago to DAYS_AHEAD days ahead are
+        loaded up front. Every refresh_interval seconds they are loaded
+        again in the background, which costs only a revalidation for the
+        listings that have not changed. If channel_url is given, the
+        channel directory is read again first, and listings whose last
+        modified stamp has not changed are not requested at all. Days
+        falling out of that range are dropped, and days coming into it
+        are loaded. A channel's index is replaced whole when it changes,
+        so queries never wait for a refresh.
+    """
+    DAYS_BEHIND = 1
+    DAYS_AHEAD = 2
+    REFRESH_INTERVAL = 15*60
+
+    def __init__(self, channels, cache, jobs=8, refresh_interval=None, channel_url=None):
+        self.channels = channels if isinstance(channels, ChannelDirectory) else ChannelDirectory(channels)
+        self.cache = cache
+        self.channel_url = channel_url
+        self.jobs = jobs
+        self.refresh_interval = refresh_interval or self.REFRESH_INTERVAL
+        self.refreshed = None
+        self.refreshes = 0
+        # the listings that failed to load in the last refresh
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def days(self):
+        today = date.today()
+        return [today + timedelta(i) for i in range(-self.DAYS_BEHIND, self.DAYS_AHEAD + 1)]
+
+    def load(self):
+        fetch_programs(self.channels.values(), self.days(), self.cache, jobs=self.jobs)
+        self.refreshed = datetime.now()
+
+    # Reads the dates and last modified stamps of the channels' listings
+    # from the channel directory again.
+    def update_stamps(self):
+        directory = parse_channels(self.channel_url, self.cache, quiet=True)
+        for id, chan in self.channels.items():
+            latest = directory.get(id)
+            if latest is not None:
+                chan.dates = latest.dates
+                chan.modified = latest.modified
+
+    # Loads every day in range again, returning the number of listings
+    # that had changed. A listing (or directory) that fails to load is
+    # reported, and what was loaded before is kept until the next refresh.
+    def refresh(self):
+        if self.channel_url is not None:
+            try:
+                self.update_stamps()
+            except Exception as e:
+                print("Failed to refresh the channel directory: {}".format(e), file=sys.stderr)
+        days = self.days()
+        keep = { d.isoformat() for d in days }
+        for chan in self.channels.values():
+            for iso in chan.loaded():
+                if iso not in keep:
+                    chan.unload(iso)
+
+        changed = failed = 0
+        pool = ThreadPoolExecutor(max_workers=max(self.jobs, 1))
+        try:
+            futures = { pool.submit(chan.refresh, d, self.cache, quiet=True): (chan, d)
+                        for chan in self.channels.values() for d in days }
+            for future, (chan, d) in futures.items():
+                try:
+                    changed += future.result()
+                except Exception as e:
+                    failed += 1
+                    print("Failed to refresh {} {}: {}".format(chan.id, d.isoformat(), e), file=sys.stderr)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        self.refreshed = datetime.now()
+        self.refreshes += 1
+        self.failures = failed
+        return changed
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _worker(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            # keep serving the listings already loaded
+            except Exception as e:
+                print("Failed to refresh listings: {}".format(e), file=sys.stderr)
+
+    def channel(self, id):
+        chan = self.channels.get(id)
+        if chan is None:
+            raise KeyError(id)
+        return chan
+
+    def programs(self, id, start, end):
+        return list(self.channel(id).index.window(start, end))
+
+    # Returns the program on at the given time (or None), and the one
+    # after it.
+    def now_next(self, id, at):
+        index = self.channel(id).index
+        on = index.window(at, at + timedelta.resolution)
+        i = bisect_right(index.starts, at)
+        return (on[-1] if len(on) else None,
+                index.programs[i] if i < len(index.programs) else None)
+
+    def search(self, query, limit=None):
+        return self.channels.search(query, limit=limit)
+
+    def status(self):
+        return {
+            "channels": len(self.channels),
+            "programs": sum(len(chan.index) for chan in self.channels.values()),
+            "days": [d.isoformat() for d in self.days()],
+            "refreshed": self.refreshed.isoformat() if self.refreshed else None,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
+
+class QueryError(Exception):
+    def __init__(self, code, msg):
+        super().__init__(msg)
+        self.code = code
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """Answers queries on a ListingService as JSON:
+
+        GET /status
+        GET /channels?q=QUERY&limit=N
+        GET /channels/ID/programs?start=ISO&end=ISO
+        GET /now?channel=ID[,ID...]&at=ISO
+        GET /programs?channel=ID[,ID...]&start=ISO&end=ISO
+
+        Times are ISO 8601 date-times, taken as local time unless they carry
+        an offset. A missing start or end is taken as now, and the end
+        defaults to two hours after the start.
+    """
+    protocol_version = "HTTP/1.1"
+    # the headers and body are written separately; don't let the body wait
+    # for the client to acknowledge the headers
+    disable_nagle_algorithm = True
+    DEFAULT_RANGE = timedelta(0, 60*60*2)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = { key: values[-1] for key, values in parse_qs(url.query).items() }
+        parts = [unquote(part) for part in url.path.split("/") if part]
+        try:
+            if parts == ["status"]:
+                body = self.server.service.status()
+            elif parts == ["channels"]:
+                body = self.channels(query)
+            elif len(parts) == 3 and parts[0] == "channels" and parts[2] == "programs":
+                start, end = self.range(query)
+                body = [prog.to_dict() for prog in self.server.service.programs(parts[1], start, end)]
+            elif parts == ["now"]:
+                body = self.now(query)
+            elif parts == ["programs"]:
+                start, end = self.range(query)
+                body = { id: [prog.to_dict() for prog in self.server.service.programs(id, start, end)]
+                         for id in self.channel_ids(query) }
+            else:
+                raise QueryError(404, "Not found: {}".format(url.path))
+            self.send_json(200, body)
+        except KeyError as e:
+            self.send_json(404, { "error": "Channel {} not found.".format(e.args[0]) })
+        except QueryError as e:
+            self.send_json(e.code, { "error": str(e) })
+        except Exception as e:
+            print("Failed to answer {}: {!r}".format(self.path, e), file=sys.stderr)
+            self.send_json(500, { "error": "Internal error." })
+
+    def channels(self, query):
+        limit = self.integer(query, "limit")
+        return [{ "id": chan.id, "display_name": chan.display_name }
+                for chan in self.server.service.search(query.get("q", ""), limit=limit)]
+
+    def now(self, query):
+        at = self.time(query, "at") or datetime.now()
+        result = {}
+        for id in self.channel_ids(query):
+            on, next = self.server.service.now_next(id, at)
+            result[id] = { "now": on.to_dict() if on else None, "next": next.to_dict() if next else None }
+        return result
+
+    def channel_ids(self, query):
+        if not query.get("channel"):
+            raise QueryError(400, "A channel is required.")
+        return query["channel"].split(",")
+
+    def range(self, query):
+        start = self.time(query, "start") or datetime.now()
+        end = self.time(query, "end") or start + self.DEFAULT_RANGE
+        if end <= start:
+            raise QueryError(400, "The end must be after the start.")
+        return start, end
+
+    def time(self, query, key):
+        if key not in query:
+            return None
+        try:
+            t = datetime.fromisoformat(query[key])
+        except ValueError:
+            raise QueryError(400, "Invalid time for {}: {}".format(key, query[key]))
+        # listings are indexed in (naive) local time
+        if t.tzinfo is not None:
+            t = t.astimezone().replace(tzinfo=None)
+        return t
+
+    def integer(self, query, key):
+        if key not in query:
+            return None
+        try:
+            return int(query[key])
+        except ValueError:
+            raise QueryError(400, "Invalid number for {}: {}".format(key, query[key]))
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class ServiceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        super().__init__(address, ServiceHandler)
+        self.service = service
+        self.verbose = verbose
+
+# Parses "[HOST:]PORT", binding to the local host if no host is given.
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+# Loads the listings of the given channels and answers queries on them at
+# the given address until interrupted.
+def serve(channels, cache, address=("127.0.0.1", 8080), jobs=8, refresh_interval=None, verbose=False, channel_url=None):
+    service = ListingService(channels, cache, jobs=jobs, refresh_interval=refresh_interval, channel_url=channel_url)
+    with Progress("Loading listings", overwrite=True):
+        service.load()
+    service.start()
+
+    server = ServiceServer(address, service, verbose=verbose)
+    print("Serving {} channels on http://{}:{}/".format(len(service.channels), *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
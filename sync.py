@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+import sys
+import json
+import hashlib
+import threading
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from util import *
+
+class SyncProgress:
+    """Records which (channel, day) pairs of a sync run have been fetched.
+
+        The record is kept in the cache directory and identified by the set
+        of pairs being synced, so that running the same sync again after
+        an interruption skips the pairs that were already fetched.
+    """
+    ID = "quick-xmltv:sync-progress"
+
+    def __init__(self, cache, pairs):
+        self.cache = cache
+        self.run = hashlib.sha1("\n".join(sorted(pairs)).encode()).hexdigest()
+        self.done = set()
+        self._lock = threading.Lock()
+
+        try:
+            with cache.open(self.ID, "r") as fp:
+                record = json.load(fp)
+            if record.get("run") == self.run and not record.get("complete"):
+                self.done = set(record.get("done", [])) & set(pairs)
+        except (OSError, ValueError):
+            pass
+
+    def mark(self, pair):
+        with self._lock:
+            self.done.add(pair)
+            self.save()
+
+    def finish(self):
+        with self._lock:
+            self.save(complete=True)
+
+    def save(self, complete=False):
+        record = { "run": self.run, "complete": complete, "done": sorted(self.done) }
+        self.cache.write_atomic(self.cache.get_cache_path(self.ID), json.dumps(record).encode())
+
+# Returns the (channel, date) pairs to sync for the given number of days
+# from start, skipping days a channel has no listings for.
+def sync_pairs(channels, days, start=None):
+    start = start or date.today()
+    pairs = []
+    for chan in channels:
+        for i in range(days):
+            d = start + timedelta(i)
+            if len(chan.dates) == 0 or d.isoformat() in chan.dates:
+                pairs.append((chan, d))
+    return pairs
+
+# Downloads (and parses into snapshots) the listings of every channel for
+# the next `days` days, without keeping them in memory. Pairs finished by
+# an earlier, interrupted run with the same channels and days are skipped.
+# If given a ProgramSearch, each listing is indexed as it comes in. A pair
+# that fails is reported and left for the next run. Returns the number of
+# listings fetched and the number that failed.
+def sync(channels, cache, days, jobs=8, start=None, index=None, out=sys.stdout, err=sys.stderr):
+    pairs = sync_pairs(channels, days, start)
+    key = lambda chan, d: "{}_{}".format(chan.id, d.isoformat())
+    progress = SyncProgress(cache, [key(chan, d) for chan, d in pairs])
+    todo = [(chan, d) for chan, d in pairs if key(chan, d) not in progress.done]
+
+    if len(todo) < len(pairs):
+        print("Resuming sync: {} of {} listings already fetched.".format(len(pairs) - len(todo), len(pairs)), file=out)
+
+    done = failed = 0
+    pool = ThreadPoolExecutor(max_workers=max(jobs, 1))
+    try:
+        futures = { pool.submit(chan.load, d, cache, quiet=True): (chan, d) for chan, d in todo }
+        for future in as_completed(futures):
+            chan, d = futures[future]
+            try:
+                programs = future.result()
+            except Exception as e:
+                failed += 1
+                print("[{}/{}] {} {}: failed: {}".format(done + failed, len(todo), chan.id, d.isoformat(), e), file=err)
+                continue
+            if index is not None and programs:
+                url = chan.listing_url(d)
+                index.update(url, chan.id, d, cache.get_manifest(url).get("sha1sum"), programs)
+            progress.mark(key(chan, d))
+            done += 1
+            print("[{}/{}] {} {}: {}".format(done + failed, len(todo), chan.id, d.isoformat(),
+                "{} programs".format(len(programs)) if programs is not None else "not found"), file=out)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    if failed:
+        print("{} of {} listings failed; run the sync again to retry them.".format(failed, len(todo)), file=err)
+    else:
+        progress.finish()
+    return done, failed
@@ -0,0 +1,57 @@
+# The now/next board keeps each channel's programs as columns of seconds,
+# and styles its header only on a terminal.
+
+import io
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import ansi
+from xmltv import TVProgram, TVChannel, to_seconds, from_seconds
+from board import ProgramColumns, NowNextBoard, print_board
+
+AT = datetime(2024, 1, 1, 12, 10)
+
+def channel(id, dates=()):
+    return TVChannel(id, id, ["http://127.0.0.1/"], dates)
+
+def program(id, title, a, b):
+    return TVProgram(title=title, start=AT + timedelta(minutes=a), end=AT + timedelta(minutes=b), channel=id)
+
+class TTY(io.StringIO):
+    def isatty(self):
+        return True
+
+def test_seconds():
+    assert from_seconds(to_seconds(AT)) == AT
+    prog = program("ABC", "News", -10, 20)
+    assert TVProgram.from_record(prog.to_record()).to_tuple() == prog.to_tuple()
+
+def test_now_next():
+    abc, sbs = channel("ABC"), channel("SBS")
+    board = NowNextBoard([abc, sbs], cache=None)
+    board.columns["ABC"] = columns = ProgramColumns(board.strings)
+    columns.add([program("ABC", "Late", 20, 50), program("ABC", "News", -10, 20)])
+    rows = board.query(AT)
+    assert rows[0] == (abc, (AT - timedelta(minutes=10), AT + timedelta(minutes=20), "News"),
+                       (AT + timedelta(minutes=20), AT + timedelta(minutes=50), "Late"))
+    assert rows[1] == (sbs, None, None)
+
+def test_header_styled():
+    board = NowNextBoard([channel("ABC")], cache=None)
+    assert board.render(AT, columns=40)[0].startswith(ansi.BWHITE)
+    assert ansi.BWHITE not in board.render(AT, columns=40, styled=False)[0]
+
+def test_print_board_tty():
+    # not listed on the day, so nothing is loaded
+    channels = [channel("ABC", ["2000-01-01"])]
+    out = io.StringIO()
+    print_board(channels, None, AT, out=out)
+    assert "\033" not in out.getvalue()
+    assert out.getvalue().splitlines()[1].split() == ["Channel", "Now", "Next"]
+
+    out = TTY()
+    print_board(channels, None, AT, out=out)
+    assert out.getvalue().splitlines()[1].startswith(ansi.BWHITE)
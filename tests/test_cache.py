@@ -0,0 +1,168 @@
+# The cache's connection pool against a local stand-in server that counts
+# the connections it accepts.
+
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from ecache import Cache
+from feedserver import FeedServer
+
+def serve(tmp_path, files=16, size=4096, **kwargs):
+    directory = tmp_path / "feed"
+    directory.mkdir()
+    for i in range(files):
+        (directory / "{}.bin".format(i)).write_bytes(os.urandom(size))
+    return FeedServer(str(directory), **kwargs).start()
+
+def new_cache(tmp_path, **kwargs):
+    cache = Cache(str(tmp_path / "cache"), **kwargs)
+    # talk to the stand-in directly, whatever the environment says
+    cache.pool.proxies = {}
+    return cache
+
+def payload(server, i):
+    with open(os.path.join(server.directory, "{}.bin".format(i)), "rb") as fp:
+        return fp.read()
+
+def test_connections_per_job(tmp_path):
+    jobs = 4
+    server = serve(tmp_path, files=32, latency=0.02)
+    try:
+        cache = new_cache(tmp_path, pool_size=jobs)
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            data = list(pool.map(lambda i: cache.fetch(server.url + "{}.bin".format(i)), range(32)))
+        assert data == [payload(server, i) for i in range(32)]
+        assert server.counters["requests"] == 32
+        assert server.counters["connections"] <= jobs
+        assert cache.pool.connections <= jobs
+    finally:
+        server.stop()
+
+def test_idle_timeout_retry(tmp_path):
+    server = serve(tmp_path, files=2, idle_timeout=0.2)
+    try:
+        cache = new_cache(tmp_path)
+        assert cache.fetch(server.url + "0.bin") == payload(server, 0)
+        # the server closes the kept-alive connection; the pool still
+        # thinks it is usable, and has to retry on a new one
+        time.sleep(0.5)
+        assert cache.fetch(server.url + "1.bin") == payload(server, 1)
+        assert server.counters["connections"] == 2
+        assert server.counters["ok"] == 2
+    finally:
+        server.stop()
+
+def test_not_modified(tmp_path):
+    server = serve(tmp_path, files=1, max_age=0)
+    try:
+        cache = new_cache(tmp_path)
+        url = server.url + "0.bin"
+        assert cache.fetch(url) == payload(server, 0)
+        assert cache.fetch(url) == payload(server, 0)
+        assert (server.counters["ok"], server.counters["not_modified"]) == (1, 1)
+        assert cache.counters["revalidated"] == 1
+        # over the same connection
+        assert server.counters["connections"] == 1
+    finally:
+        server.stop()
+
+# Saves entries first..first+count-1, each of `size` bytes, oldest first.
+def fill(cache, count, size=1000, first=0):
+    for i in range(first, first + count):
+        cache.save("entry-{}".format(i), os.urandom(size))
+        # distinct access times, so the LRU order is certain
+        time.sleep(0.01)
+
+def cached_ids(cache):
+    return sorted(int(row["url"].split("-")[1]) for row in cache.index.lru(1000))
+
+def test_evict_max_entries(tmp_path):
+    cache = new_cache(tmp_path, max_entries=5)
+    fill(cache, 12)
+    assert cached_ids(cache) == list(range(7, 12))
+    assert cache.counters["evictions"] == 7
+
+def test_evict_max_bytes(tmp_path):
+    cache = new_cache(tmp_path, max_bytes=3500)
+    fill(cache, 8)
+    assert cached_ids(cache) == [5, 6, 7]
+    assert cache.index.totals() == (3, 3000)
+
+def test_evict_aux(tmp_path):
+    cache = new_cache(tmp_path, max_entries=2)
+    fill(cache, 1)
+    cache.save_aux("entry-0", "programs", b"[]")
+    path = cache.get_cache_path("entry-0")
+    assert os.path.exists(path + ".programs")
+    # the auxiliary file counts towards the entry's size
+    assert cache.index.totals() == (1, 1002)
+    fill(cache, 2, first=1)
+    assert cached_ids(cache) == [1, 2]
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + ".programs")
+
+def test_evict_skips_locked(tmp_path):
+    cache = new_cache(tmp_path, max_entries=3)
+    fill(cache, 3)
+    keys = [cache.get_key("entry-{}".format(i)) for i in range(3)]
+    # entries share a lock file with others of the same key prefix
+    assert keys[0][:Cache.LOCK_PREFIX] != keys[1][:Cache.LOCK_PREFIX]
+    lock = cache.get_lock(keys[0])
+    assert lock.acquire()
+    try:
+        cache.save("entry-3", os.urandom(1000))
+    finally:
+        lock.release()
+    assert cached_ids(cache) == [0, 2, 3]
+
+def tmp_files(cache):
+    return [name for root, dirs, files in os.walk(cache.cache_dir) for name in files if name.endswith(".tmp")]
+
+def test_stream_closed_early(tmp_path):
+    server = serve(tmp_path, files=1, size=256 * 1024)
+    try:
+        cache = new_cache(tmp_path)
+        url = server.url + "0.bin"
+        fp = cache.fetch_stream(url)
+        assert not fp.from_cache
+        fp.read(1024)
+        assert len(tmp_files(cache)) == 1
+        fp.close()
+        assert tmp_files(cache) == []
+        assert cache.index.get(cache.get_key(url)) is None
+        assert not os.path.exists(cache.get_cache_path(url))
+
+        # the entry's lock was released, and a full read commits it
+        assert cache.fetch(url) == payload(server, 0)
+        assert tmp_files(cache) == []
+        assert cache.index.get(cache.get_key(url))["size"] == 256 * 1024
+    finally:
+        server.stop()
+
+def test_coalesced_fetches(tmp_path):
+    server = serve(tmp_path, files=1, size=64 * 1024, latency=0.2, max_age=0)
+    try:
+        cache = new_cache(tmp_path)
+        url = server.url + "0.bin"
+        start = threading.Barrier(8)
+        def fetch(i):
+            start.wait()
+            return cache.fetch(url)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            data = list(pool.map(fetch, range(8)))
+        assert data == [payload(server, 0)] * 8
+        # one download; the other threads asked while it was under way,
+        # so they use it without revalidating
+        assert server.counters["requests"] == 1
+        assert (cache.counters["downloads"], cache.counters["coalesced"]) == (1, 7)
+    finally:
+        server.stop()
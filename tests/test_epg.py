@@ -0,0 +1,53 @@
+# Navigating the EPG reuses the memoized listings: a key press computes
+# the listings at most once, when it moves the window.
+
+import io
+import os
+import sys
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xmltv import TVProgram, TVChannel
+from ui import EPG, align_time
+
+def channel(id, start, days=3):
+    chan = TVChannel(id, id, ["http://127.0.0.1/"])
+    for n in range(days):
+        d = start.date() + timedelta(n - 1)
+        first = datetime.combine(d, datetime.min.time())
+        progs = [TVProgram(title="{} {}".format(id, i), channel=id,
+                           start=first + timedelta(minutes=i*20), end=first + timedelta(minutes=(i+1)*20))
+                 for i in range(24*3)]
+        chan.programs[d.isoformat()] = progs
+        chan.index.add(progs)
+    return chan
+
+def new_epg():
+    start = align_time(datetime.now())
+    channels = [channel(id, start) for id in ("ABC", "SBS", "SEVEN")]
+    with redirect_stdout(io.StringIO()):
+        return EPG(channels, start, start + timedelta(hours=2), cache=None, prefetch=False)
+
+def test_one_miss_per_key():
+    epg = new_epg()
+    keys = (EPG.RIGHT[0],) * 8 + (EPG.DOWN[0],) * 3 + (EPG.LEFT[0],) * 8 + (EPG.UP[0],) * 3 + ("\r",)
+    with redirect_stdout(io.StringIO()):
+        for key in keys:
+            misses = epg.listings_misses
+            hits = epg.listings_hits
+            epg._epg_listener(key)
+            assert epg.listings_misses - misses <= 1, key
+            assert epg.listings_hits > hits
+
+def test_moves_without_misses():
+    epg = new_epg()
+    with redirect_stdout(io.StringIO()):
+        epg._epg_listener(EPG.DOWN[0])
+        misses = epg.listings_misses
+        epg._epg_listener(EPG.DOWN[0])
+        epg._epg_listener(EPG.UP[0])
+        epg._epg_listener("\r")
+    assert epg.listings_misses == misses
+    assert epg.stats() == {"listings_hits": epg.listings_hits, "listings_misses": epg.listings_misses}
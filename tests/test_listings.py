@@ -0,0 +1,89 @@
+# ProgramIndex.window must give what filtering and sorting every program
+# (as get_program_listings used to) gives, including for programs nested
+# inside longer ones.
+
+import os
+import sys
+import random
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xmltv import TVProgram, TVChannel, get_program_listings
+
+FIRST = datetime(2024, 1, 1, 6)
+
+# The previous implementation of get_program_listings.
+def reference(channels, start=None, end=None):
+    fil = lambda p: (start is None or end is None) or (p.end > start and p.start < end)
+    listings = {}
+    for c in channels:
+        listings[c.id] = sum(map(lambda d: list(filter(fil, c.programs[d])), c.programs), [])
+        listings[c.id].sort(key=lambda p: p.start)
+    if sum([len(listings[id]) for id in listings]) == 0:
+        return None
+    return listings
+
+# Returns a day of back-to-back programs, some with programs nested inside
+# or overlapping them, and some gaps.
+def day(rand, id, first, nested):
+    programs, t = [], first
+    while t < first + timedelta(1):
+        length = timedelta(minutes=5 * rand.randint(1, 36))
+        if rand.random() < 0.1:
+            t += length
+            continue
+        programs.append(TVProgram(title="P{}".format(len(programs)), start=t, end=t + length, channel=id))
+        if nested and rand.random() < 0.15:
+            # inside this one (possibly ending with it), or running past it
+            offset = timedelta(minutes=5 * rand.randint(0, 11))
+            inner = timedelta(minutes=5 * rand.randint(1, 36))
+            programs.append(TVProgram(title="N{}".format(len(programs)), start=t + offset,
+                                      end=t + offset + inner, channel=id))
+        t += length
+    return programs
+
+def channels(rand, count=6, days=3):
+    result = []
+    for i in range(count):
+        chan = TVChannel("CH{}".format(i), "Channel {}".format(i), ["http://127.0.0.1/"])
+        # days load in any order, each merged into the index
+        for d in rand.sample(range(days), days):
+            programs = day(rand, chan.id, FIRST + timedelta(d), nested=i % 2 == 1)
+            chan.programs[(FIRST + timedelta(d)).date().isoformat()] = programs
+            chan.index.add(programs)
+        result.append(chan)
+    return result
+
+def windows(rand, n):
+    for i in range(n):
+        start = FIRST - timedelta(hours=6) + timedelta(minutes=rand.randrange(0, 4 * 24 * 60))
+        yield start, start + timedelta(minutes=rand.choice([1, 5, 30, 120, 360, 24 * 60]))
+
+def listed(listings):
+    return None if listings is None else { id: [p.key() for p in progs] for id, progs in listings.items() }
+
+def test_windows():
+    rand = random.Random(4)
+    chans = channels(rand)
+    assert any(chan.index.nested for chan in chans)
+    for start, end in windows(rand, 3000):
+        assert listed(get_program_listings(chans, start, end)) == listed(reference(chans, start, end)), (start, end)
+
+def test_whole_listing():
+    chans = channels(random.Random(5))
+    assert listed(get_program_listings(chans)) == listed(reference(chans))
+
+def test_outside():
+    chans = channels(random.Random(6))
+    assert get_program_listings(chans, FIRST - timedelta(2), FIRST - timedelta(1)) is None
+    assert get_program_listings(chans, FIRST + timedelta(5), FIRST + timedelta(6)) is None
+
+def test_view_index():
+    rand = random.Random(7)
+    chans = channels(rand, count=2)
+    for start, end in windows(rand, 200):
+        for progs in (get_program_listings(chans, start, end) or {}).values():
+            for i, prog in enumerate(progs):
+                assert progs.index(prog) == i
+                assert prog in progs
@@ -0,0 +1,65 @@
+# The iterparse and minidom listing parsers must give the same programs.
+
+import io
+import os
+import sys
+import gzip
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from xmltv import iter_programs, iter_programs_dom
+from feed import generate
+
+def parse_both(data):
+    return ([p.to_tuple() for p in iter_programs(io.BytesIO(data))],
+            [p.to_tuple() for p in iter_programs_dom(io.BytesIO(data))])
+
+def listing(*programs):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<tv>{}</tv>'.format("".join(
+        '<programme start="20240101060000 +1000" stop="20240101070000 +1000" channel="ABC-NSW">'
+        '{}</programme>'.format(body) for body in programs))).encode("utf-8")
+
+def test_generated_feed(tmp_path):
+    generate(str(tmp_path), "http://127.0.0.1/", channels=4, count=2, programs=60, seed=7)
+    listings = [name for name in os.listdir(tmp_path) if name != "channels.xml.gz"]
+    assert len(listings) == 8
+    for name in listings:
+        with gzip.open(os.path.join(tmp_path, name)) as fp:
+            data = fp.read()
+        fast, dom = parse_both(data)
+        assert len(fast) == 60
+        assert fast == dom, name
+
+@pytest.mark.parametrize("body", [
+    # no <credits> or <rating>
+    '<title>News</title><desc>Headlines.</desc>',
+    # credits and a rating value outside their usual elements
+    '<title>News</title><actor>Alex Smith</actor><director>Jo Lee</director><value>PG</value>',
+    '<title>Film</title><credits><actor>Sam Brown</actor><actor>Kim Walker</actor></credits>'
+    '<rating system="ACMA"><value>M</value></rating>',
+    # empty and missing fields
+    '<title></title><sub-title/><desc></desc>',
+    '<desc>No title at all.</desc>',
+    '<title>News</title><credits/><rating/>',
+    '<title>News</title><date></date>',
+    # text split by nested tags and entities
+    '<title>Q &amp; A</title><desc>Some <b>bold</b> and <i>nested <u>deep</u></i> text.</desc>',
+    '<title>Doctor Who</title><sub-title lang="en">The <em>Return</em></sub-title>'
+    '<credits><director>Pat <b>Nguyen</b></director></credits>',
+    # repeated elements take the first
+    '<title>First</title><title>Second</title><date>1999</date><date>2001</date>'
+    '<category>Drama</category><category>Movie</category>',
+])
+def test_edge_cases(body):
+    fast, dom = parse_both(listing(body))
+    assert len(fast) == 1
+    assert fast == dom
+
+def test_many_programs():
+    fast, dom = parse_both(listing(*['<title>Show {}</title>'.format(i) for i in range(500)]))
+    assert len(fast) == 500
+    assert fast == dom
@@ -0,0 +1,98 @@
+# The EPG grid is laid out in CellLines: styles become escape sequences
+# only where they change, and each program owns the cells up to the next.
+
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import CellLine, ansi
+from xmltv import TVProgram, TVChannel
+from ui import render_epg
+
+HIGHLIGHT = ansi.BLACK + ansi.BG_WHITE
+ANSI_RE = re.compile(r"\033\[.*?[\x40-\x7e]")
+
+def test_plain():
+    line = CellLine(8)
+    assert line.write(2, "abc") == 5
+    assert line.render() == "  abc   "
+    assert str(line) == "  abc   "
+
+def test_clipped():
+    line = CellLine(6)
+    assert line.write(3, "abcdef") == 6
+    assert line.write(9, "xyz") == 6
+    assert str(line) == "   abc"
+
+def test_style_runs():
+    line = CellLine(6)
+    line.write(0, "abcdef")
+    line.style(1, 3, ansi.RED)
+    line.style(3, 4, ansi.BLUE)
+    assert line.render() == "a" + ansi.RED + "bc" + ansi.RESET + ansi.BLUE + "d" + ansi.RESET + "ef"
+
+def test_style_to_end():
+    line = CellLine(4)
+    line.write(0, "abcd", ansi.RED)
+    assert line.render() == ansi.RED + "abcd" + ansi.RESET
+    assert line.render(close=False) == ansi.RED + "abcd"
+    # clipped to the line
+    line.style(2, 10, ansi.BLUE)
+    assert line.render() == ansi.RED + "ab" + ansi.RESET + ansi.BLUE + "cd" + ansi.RESET
+
+def test_find():
+    line = CellLine(10)
+    line.write(0, "| a | b")
+    assert line.find("|") == 0
+    assert line.find("|", 1) == 4
+    assert line.find("|", 5) == -1
+    assert line.find("|", 1, 4) == -1
+
+START = datetime(2024, 1, 1, 12)
+
+def channel(id, *programs):
+    chan = TVChannel(id, id, ["http://127.0.0.1/"])
+    progs = [TVProgram(title=title, start=START + timedelta(minutes=a), end=START + timedelta(minutes=b), channel=id)
+             for title, a, b in programs]
+    chan.programs[START.date().isoformat()] = progs
+    chan.index.add(progs)
+    return chan
+
+CHANNELS = [
+    channel("ABC", ("News", 0, 30), ("A very long title", 30, 60), ("Movie with a long title that runs on", 60, 150)),
+    channel("SBS", ("Before the window", -60, 15), ("Late", 105, 120)),
+]
+# the first column is as wide as the date, and a space; 48 cells are
+# left for two hours, 2.5 minutes each
+COLUMNS = 11 + 48
+
+def prefix(id):
+    return ansi.BWHITE + " " * (10 - len(id)) + id + " " + ansi.RESET
+
+def render(highlight=None):
+    return render_epg(CHANNELS, START, START + timedelta(hours=2), highlight, columns=COLUMNS)
+
+def test_rows_clipped():
+    lines = render()
+    assert len(lines) == 3
+    for line in lines[1:]:
+        assert len(ANSI_RE.sub("", line)) == COLUMNS
+    # each title is cut where the next program starts, and the last at the
+    # end of the row
+    assert lines[1] == prefix("ABC") + "| News      " + "| A very lon" + "| Movie with a long titl" + ansi.RESET
+    assert lines[2] == prefix("SBS") + "| Before the window".ljust(42) + "| Late" + ansi.RESET
+
+def test_highlight():
+    abc = CHANNELS[0].programs[START.date().isoformat()]
+    row = render(abc[1])[1]
+    assert row == prefix("ABC") + "| News      " + HIGHLIGHT + "| A very lon" + ansi.RESET + \
+        "| Movie with a long titl" + ansi.RESET
+    # the last program is highlighted to the end of the row
+    row = render(abc[2])[1]
+    assert row.endswith(HIGHLIGHT + "| Movie with a long titl" + ansi.RESET)
+    assert row.count(HIGHLIGHT) == 1
+    # not on another channel's row
+    assert HIGHLIGHT not in render(abc[0])[2]
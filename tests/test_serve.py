@@ -0,0 +1,67 @@
+# The listing service keeps serving (and refreshing the rest) when a
+# listing fails, and takes query times with offsets as local times.
+
+import os
+import sys
+import json
+import time
+import threading
+import urllib.request
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from ecache import Cache
+from xmltv import parse_channels
+from serve import ListingService, ServiceServer
+from feed import generate
+from feedserver import FeedServer
+
+@pytest.fixture
+def service(tmp_path):
+    feed = FeedServer(str(tmp_path / "feed"), max_age=0).start()
+    ids, dates = generate(feed.directory, feed.url, channels=3, count=4, programs=20)
+    cache = Cache(str(tmp_path / "cache"))
+    channel_url = feed.url + "channels.xml.gz"
+    service = ListingService(parse_channels(channel_url, cache), cache, jobs=2, channel_url=channel_url)
+    service.load()
+    yield service, feed, ids, dates
+    feed.stop()
+
+def test_refresh_failure(service, capsys):
+    service, feed, ids, dates = service
+    # revalidate each listing, rather than trusting the directory's stamps
+    service.channel_url = None
+    for chan in service.channels.values():
+        chan.modified.clear()
+    loaded = service.status()["programs"]
+    path = os.path.join(feed.directory, "{}_{}.xml.gz".format(ids[0], dates[1].isoformat()))
+    with open(path, "wb") as fp:
+        fp.write(b"not a listing")
+    # a different modification time, so the server reads it again
+    os.utime(path, (time.time() + 10, time.time() + 10))
+
+    assert service.refresh() == 0
+    status = service.status()
+    assert (status["refreshes"], status["failures"], status["programs"]) == (1, 1, loaded)
+    assert "Failed to refresh {} {}".format(ids[0], dates[1].isoformat()) in capsys.readouterr().err
+
+def test_aware_times(service):
+    service = service[0]
+    server = ServiceServer(("127.0.0.1", 0), service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        base = "http://127.0.0.1:{}/now?channel={}&at=".format(server.server_address[1], next(iter(service.channels)))
+        now = datetime.now().replace(microsecond=0)
+        def get(at):
+            with urllib.request.urlopen(base + urllib.request.quote(at.isoformat())) as res:
+                return json.load(res)
+        assert get(now) == get(now.astimezone(timezone(timedelta(hours=10))))
+        assert get(now) == get(now.astimezone(timezone(timedelta(hours=-5))))
+    finally:
+        server.shutdown()
+        server.server_close()
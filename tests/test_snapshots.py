@@ -0,0 +1,46 @@
+# Snapshots store programs as JSON records, which must give back the same
+# programs, and never load anything else.
+
+import io
+import os
+import sys
+import gzip
+import pickle
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from ecache import Cache
+from xmltv import TVProgram, SNAPSHOT_EXT, iter_programs, load_snapshot, save_snapshot
+from feed import generate
+
+URL = "http://127.0.0.1/CH000-NSW_2024-01-01.xml.gz"
+
+def programs(tmp_path):
+    ids, dates = generate(str(tmp_path / "feed"), "http://127.0.0.1/", channels=1, count=1, programs=60)
+    with gzip.open(str(tmp_path / "feed" / "{}_{}.xml.gz".format(ids[0], dates[0].isoformat()))) as fp:
+        return list(iter_programs(fp))
+
+def cached(tmp_path):
+    cache = Cache(str(tmp_path / "cache"))
+    cache.save(URL, b"listing", { "sha1sum": "abc" })
+    return cache
+
+def test_records(tmp_path):
+    progs = programs(tmp_path) + [TVProgram(title="Empty", start=TVProgram.parseTimestamp("20240101060000 +1000"),
+                                            end=TVProgram.parseTimestamp("20240101063000 +1000"))]
+    assert [TVProgram.from_record(p.to_record()).to_tuple() for p in progs] == [p.to_tuple() for p in progs]
+
+def test_snapshot(tmp_path):
+    progs = programs(tmp_path)
+    cache = cached(tmp_path)
+    save_snapshot(cache, URL, "abc", progs)
+    assert [p.to_tuple() for p in load_snapshot(cache, URL, "abc")] == [p.to_tuple() for p in progs]
+    # another version of the listing
+    assert load_snapshot(cache, URL, "def") is None
+
+def test_pickled_snapshot(tmp_path):
+    cache = cached(tmp_path)
+    cache.save_aux(URL, SNAPSHOT_EXT, pickle.dumps((1, "abc", [p.to_tuple() for p in programs(tmp_path)])))
+    assert load_snapshot(cache, URL, "abc") is None
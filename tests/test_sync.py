@@ -0,0 +1,51 @@
+# A sync reports listings that fail, fetches the rest, and retries only
+# the failed ones on the next run.
+
+import io
+import os
+import sys
+import shutil
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from ecache import Cache
+from xmltv import parse_channels
+from sync import sync
+from feed import generate
+from feedserver import FeedServer
+
+@pytest.fixture
+def server(tmp_path):
+    server = FeedServer(str(tmp_path / "feed")).start()
+    yield server
+    server.stop()
+
+def test_failed_listing(tmp_path, server):
+    ids, dates = generate(server.directory, server.url, channels=3, count=2, programs=10)
+    broken = os.path.join(server.directory, "{}_{}.xml.gz".format(ids[1], dates[0].isoformat()))
+    shutil.move(broken, broken + ".good")
+    with open(broken, "wb") as fp:
+        fp.write(b"not a listing")
+
+    cache = Cache(str(tmp_path / "cache"))
+    channels = list(parse_channels(server.url + "channels.xml.gz", cache).values())
+    out, err = io.StringIO(), io.StringIO()
+    assert sync(channels, cache, 2, jobs=2, start=dates[0], out=out, err=err) == (5, 1)
+    assert "{} {}: failed".format(ids[1], dates[0].isoformat()) in err.getvalue()
+    assert "1 of 6 listings failed" in err.getvalue()
+
+    # the next run fetches only the listing that failed
+    shutil.move(broken + ".good", broken)
+    server.reset()
+    out = io.StringIO()
+    assert sync(channels, cache, 2, jobs=2, start=dates[0], out=out, err=err) == (1, 0)
+    assert "5 of 6 listings already fetched" in out.getvalue()
+    assert server.counters["requests"] == 1
+
+    # and once complete, a new run starts over
+    out = io.StringIO()
+    assert sync(channels, cache, 2, jobs=2, start=dates[0], out=out, err=err) == (6, 0)
@@ -0,0 +1,57 @@
+# TVProgram.parseTimestamp's fast path for full timestamps must agree with
+# the general parsePartialTimestamp on every input.
+
+import os
+import sys
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from xmltv import TVProgram
+
+OFFSETS = ["+0000", "-0000", "+1000", "+1100", "+0930", "+0545", "-0500", "-0330", "+1400", "-1200"]
+
+# Returns the value fn gives for ts, or the type of exception it raises.
+def outcome(fn, ts, ignore_timezone):
+    try:
+        return fn(ts, ignore_timezone=ignore_timezone)
+    except Exception as e:
+        return type(e)
+
+def check(ts):
+    for ignore_timezone in (False, True):
+        assert (outcome(TVProgram.parseTimestamp, ts, ignore_timezone) ==
+                outcome(TVProgram.parsePartialTimestamp, ts, ignore_timezone)), (ts, ignore_timezone)
+
+def test_random_full_timestamps():
+    rand = random.Random(9)
+    first = datetime(1970, 1, 1)
+    for i in range(5000):
+        d = first + timedelta(seconds=rand.randrange(100 * 365 * 24 * 60 * 60))
+        check("{} {}".format(d.strftime("%Y%m%d%H%M%S"), rand.choice(OFFSETS)))
+
+@pytest.mark.parametrize("offset", OFFSETS)
+def test_offsets(offset):
+    check("20240229235959 " + offset)
+    check("20241231000000 " + offset)
+
+@pytest.mark.parametrize("ts", [
+    # partial precision, with and without an offset
+    "2024", "202402", "20240229", "2024022918", "202402291830", "20240229183015",
+    "2024 +1000", "20240229 -0500", "202402291830 +0930",
+    # empty
+    "", None,
+])
+def test_partial_and_empty(ts):
+    check(ts)
+
+@pytest.mark.parametrize("ts", [
+    "2024010106003X +1000", "20241301060000 +1000", "20240132060000 +1000", "20240101250000 +1000",
+    "20240101060000 +10:0", "20240101060000 x1000", "20240101060000 +10", "20240101060000 1000",
+    "20240101060000  +1000", "2024-01-01T06:00 +1000", "abcdefghijklmn +1000", "20240101060000+1000",
+])
+def test_malformed(ts):
+    check(ts)
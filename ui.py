@@ -1,123 +1,158 @@
 #!/usr/bin/python3
 
-import re
+import sys
 import shutil
+import textwrap
+import threading
 from time import sleep
 from math import floor, ceil
 from urllib.error import HTTPError
 from abc import ABCMeta, abstractmethod
 from datetime import datetime, date, time, timedelta
 
+import perf
 from getch import getch
 from util import *
-from xmltv import get_program_listings
-
-def ask_channels(channels, selection=[]):
-    def final_choice(chan=None, retry=True):
-        items = ["[F]inish", "[L]ist"]
-        if chan != None: items.append("[C]ontinue")
-        if retry: items.append("[R]etry")
-        prompt = ", ".join(items) + "? "
-        choice = sensible_input(prompt).lower()[0]
-
-        if choice == "c" and chan != None:
-            if chan.id in selection:
-                print("Channel has already been selected!")
-            else: selection.append(chan.id)
-            return ask_channels(channels, selection)
-        elif choice == "r" and retry:
-            return ask_channels(channels, selection)
-        elif choice == "f":
-            if chan != None:
-                if chan.id in selection:
-                    print("Channel has already been selected!")
-                else: selection.append(chan.id)
-            return [channels[id] for id in selection]
-        elif choice == "l":
-            for id in selection:
-                print(str(channels[id]))
-            print("[*] {}".format(str(chan)))
-            return final_choice(chan)
-        else:
-            print("Invalid choice.")
-            return final_choice(chan)
-
-    clear()
-    query = sensible_input("Type a channel ID, or a search query (^C to quit): ")
-    print("")
-
-    matches = [channels[id] for id in channels if channels[id].matches(query) and id not in selection]
-
-    if len(matches) == 0:
-        print("No matches found.")
-        return final_choice()
-    elif len(matches) == 1:
-        print("Single match found: {}".format(str(matches[0])))
-        return final_choice(matches[0])
-    else:
+from xmltv import get_program_listings, fetch_programs
+
+def ask_channels(channels, selection=None):
+    selection = [] if selection is None else selection
+
+    def select(chan):
+        if chan.id in selection:
+            print("Channel has already been selected!")
+        else: selection.append(chan.id)
+
+    while True:
+        chan, retry = search_channels(channels, selection)
+
+        while True:
+            items = ["[F]inish", "[L]ist"]
+            if chan != None: items.append("[C]ontinue")
+            if retry: items.append("[R]etry")
+            prompt = ", ".join(items) + "? "
+            choice = sensible_input(prompt).lower()[:1]
+
+            if choice == "c" and chan != None:
+                select(chan)
+                break
+            elif choice == "r" and retry:
+                break
+            elif choice == "f":
+                if chan != None:
+                    select(chan)
+                return [channels[id] for id in selection]
+            elif choice == "l":
+                for id in selection:
+                    print(str(channels[id]))
+                print("[*] {}".format(str(chan)))
+            else:
+                print("Invalid choice.")
+
+# Asks for a search query and for one of the channels matching it.
+# Returns the chosen channel (or None), and whether the user can retry.
+def search_channels(channels, selection):
+    while True:
+        clear()
+        query = ask_query(channels, selection, "Type a channel ID, or a search query (^C to quit): ")
+        print("")
+
+        matches = [chan for chan in channels.search(query) if chan.id not in selection]
+
+        if len(matches) == 0:
+            print("No matches found.")
+            return None, True
+        elif len(matches) == 1:
+            print("Single match found: {}".format(str(matches[0])))
+            return matches[0], True
+
         print("{} matches:".format(len(matches)))
         for i, chan in enumerate(matches):
             print("[{}] {}".format(i, str(chan)))
 
         choice = sensible_input("Select [0-{}], [R]etry? ".format(len(matches)-1))
-        if choice[0].lower() == "r":
-            return ask_channels(channels, selection)
+        if choice[:1].lower() == "r":
+            continue
 
         try:
-            index = int(choice)
-        except ValueError:
-            print("Invalid selection.")
-            return ask_channels(channels, selection)
-        except IndexError:
+            return matches[int(choice)], False
+        except (ValueError, IndexError):
             print("Invalid selection.")
-            return ask_channels(channels, selection)
 
-        return final_choice(matches[index], retry=False)
+# Reads a search query, showing the best matches for it as it is typed
+# when reading from a terminal.
+def ask_query(channels, selection, prompt):
+    if not sys.stdin.isatty():
+        return sensible_input(prompt)
+
+    screen = Screen()
+    query = ""
+    try:
+        while True:
+            rows = shutil.get_terminal_size((80, 24))[1]
+            limit = max(rows - 3, 1)
+            matches = channels.search(query, limit=limit + len(selection)) if query else []
+            matches = [chan for chan in matches if chan.id not in selection][:limit]
+            screen.draw([prompt + query, ""] + [str(chan) for chan in matches], cursor=(0, len(prompt + query)))
 
-def print_epg(channels, start, end, highlight=None):
-    ANSI_RE     = re.compile(r'(\033\[.*?[\x40-\x7e])')
-    escs        = lambda s, end=None: sum(map(len, ANSI_RE.findall(s[:end])))
-    align       = lambda dt, align=60*30: datetime.fromtimestamp(floor(dt.timestamp() / align) * align)
+            try:
+                ch = getch()
+            except KeyboardInterrupt:
+                screen.close()
+                print("^C")
+                exit(0)
+
+            if ch in ("\r", "\n"):
+                break
+            elif ch in ("\x7f", "\b"):
+                query = query[:-1]
+            elif ch == "\033":
+                # skip over escape sequences (e.g. arrow keys)
+                if getch() == "[":
+                    while ord(getch()) not in range(64, 127):
+                        pass
+            elif ch.isprintable():
+                query += ch
+    finally:
+        screen.close()
+
+    print(prompt + query)
+    return query
+
+def print_epg(channels, start, end, highlight=None, get_listings=None):
+    for line in render_epg(channels, start, end, highlight, get_listings):
+        print(line)
+
+# Lays out the EPG grid for the given window, returning its lines (with
+# ANSI escape sequences). Each row is built in a CellLine, so placing a
+# program costs only the length of its title.
+@perf.timed("epg.render")
+def render_epg(channels, start, end, highlight=None, get_listings=None, columns=None):
     timestr     = lambda dt: dt.strftime("%H:%M")
     time_to_pos = lambda dt, length: min(int((max(dt - start, ZERODELTA).seconds / gap.seconds) * length), length)
 
-    def cover(full, sub, start, bound=True, overwrite=True, fill=False, fillchar=" "):
-        start = max(start, 0)
-        end = start + (len(sub) if overwrite else 0)
-        prefix = full[:start]
-        if len(prefix) < start and fill:
-            prefix += fillchar * (start - len(prefix) - 1)
-        s = prefix + sub + full[end:]
-        if bound: s = s[:len(full)]
-        return s
-
-    def insert(full, sub, start, **kwargs):
-        return cover(full, sub, start, overwrite=False, **kwargs)
-
-    def fillto(s, start, fillto, fillchar=" ", bound=True):
-        i = s.find(fillto, start)
-        if i == -1:
-            i = len(s)
-        s = cover(s, (i - start) * fillchar, start, bound)
-        return s
-
-    columns, rows = shutil.get_terminal_size((80, 24))
+    if columns is None:
+        columns, rows = shutil.get_terminal_size((80, 24))
     SZ = 5 # len("00:00")
     ZERODELTA = timedelta(0)
+    HIGHLIGHT = ansi.BLACK + ansi.BG_WHITE
 
     if isinstance(start, str): start = iso_to_datetime(start)
     if isinstance(end, str): end = iso_to_datetime(end)
-    start = align(start)
-    end = align(end)
+    start = align_time(start)
+    end = align_time(end)
     gap = end - start
 
-    listings = get_program_listings(channels, start, end)
+    if get_listings is None:
+        get_listings = lambda start, end: get_program_listings(channels, start, end)
+    listings = get_listings(start, end)
     if not listings:
         abort("No programs found.")
 
     # end = align(max([max(listings[id], key=lambda p:p.end) for id in listings], key=lambda p:p.end).end)
     # end = align(max([max([p.end for p in listings[id]]) for id in listings]))
 
+    lines = []
     datestr = start.date().isoformat()
     firstcol_len = max([len(c.id) for c in channels])
     firstcol_len = max(len(datestr), firstcol_len) + 1
@@ -136,34 +171,36 @@ def print_epg(channels, start, end, highlight=None):
     # time_scale += timestr(start + (gap / divisions) * int(divisions))
     i = time_to_pos(datetime.now(), remaining)
     i = max(0, min(i, columns - firstcol_len - 1))
-    part = ansi.BLACK + ansi.BG_WHITE
-    time_scale = insert(insert(time_scale, part, i, bound=False), ansi.RESET, i + len(part) + 1, bound=False)
-    print(prefix + time_scale)
+    scale = CellLine(max(len(time_scale), i + 1))
+    scale.write(0, time_scale)
+    scale.style(i, i + 1, HIGHLIGHT)
+    lines.append(prefix + scale.render())
 
     for ch in channels:
         id = ch.id
         prefix = ansi.BWHITE + " " * (firstcol_len - len(id) - 1) + id + " " + ansi.RESET
         remaining = columns - firstcol_len
-        s = " " * remaining
+        row = CellLine(remaining)
         highlight_i = -1
-        def calci(prog, s): i = time_to_pos(prog.start, remaining); return i + escs(s, i)
-
+        # each program owns the cells up to where the next one starts
+        prev_i, prev_title = 0, None
         for prog in listings[id]:
-            i = calci(prog, s)
-            if prog == highlight:
+            i = time_to_pos(prog.start, remaining)
+            if prev_title is not None and i > prev_i:
+                row.write(prev_i, prev_title[:i - prev_i])
+            if highlight is not None and prog.start == highlight.start and prog == highlight:
                 highlight_i = i
-            part = "| " + prog.title
-            s = fillto(cover(s, part, i), i + len(part), "|")
+            prev_i, prev_title = i, "| " + prog.title
+        if prev_title is not None:
+            row.write(prev_i, prev_title)
 
         if highlight_i != -1:
-            sub = ansi.BLACK + ansi.BG_WHITE
-            s = insert(s, sub, highlight_i, bound=False)
-            next_i = s.find("|", highlight_i + len(sub) + 1)
-            if next_i != -1:
-                s = insert(s, ansi.RESET, next_i, bound=False)
+            next_i = row.find("|", highlight_i + 1)
+            row.style(highlight_i, next_i if next_i != -1 else remaining, HIGHLIGHT)
+
+        lines.append(prefix + row.render(close=False) + ansi.RESET)
 
-        s += ansi.RESET
-        print(prefix + s)
+    return lines
 
 class EPGFrameInterface(metaclass=ABCMeta):
     """ This function is called when the screen is ready to be redrawn:
@@ -235,17 +272,95 @@ class EPGMainFrame(EPGFrameInterface):
         self.update()
 
 
+class Prefetcher:
+    """Fetches channel-days in the background before they are needed.
+
+        Each call to want() replaces the queue of days to prefetch, so days
+        no longer wanted are dropped before they start. At most `jobs`
+        fetches run at once, on daemon threads: shutdown() returns at once,
+        and exiting never waits for a download in progress. on_loaded is
+        called (from a worker thread) after each day has been loaded.
+    """
+    def __init__(self, cache, jobs=4, on_loaded=None):
+        self.cache = cache
+        self.on_loaded = on_loaded
+        self.jobs = max(jobs, 1)
+        # (channel id, date) -> (channel, date), in the order wanted
+        self.queue = {}
+        self.running = set()
+        self.closed = False
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def want(self, channels, dates):
+        with self._cond:
+            if self.closed:
+                return
+            self.queue = {(ch.id, d): (ch, d) for ch in channels for d in dates
+                          if (ch.id, d) not in self.running and d.isoformat() not in ch.programs}
+            while len(self._threads) < min(self.jobs, len(self.queue)):
+                thread = threading.Thread(target=self._worker, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self.queue and not self.closed:
+                    self._cond.wait()
+                if self.closed:
+                    return
+                key = next(iter(self.queue))
+                ch, d = self.queue.pop(key)
+                self.running.add(key)
+            try:
+                self._fetch(ch, d)
+            finally:
+                with self._cond:
+                    self.running.discard(key)
+
+    def _fetch(self, ch, d):
+        try:
+            ch.fetch(d, self.cache, quiet=True)
+        except Exception:
+            # the day is left unloaded; a failure is reported if it happens
+            # again when the day is fetched for display
+            return
+        if self.on_loaded is not None and not self.closed:
+            self.on_loaded(ch, d)
+
+    def shutdown(self):
+        with self._cond:
+            self.closed = True
+            self.queue.clear()
+            self._cond.notify_all()
+
 class EPG:
     UP, DOWN, RIGHT, LEFT = ['\033[A', '\xe0H'], ['\033[B', '\xe0P'], ['\033[C', '\xe0M'], ['\033[D', '\xe0K']
     MODE_EPG, MODE_OPTIONS, MODE_CHANNELS = 0,1,2
     mode = 0
 
-    def __init__(self, channels, start, end, cache):
+    def __init__(self, channels, start, end, cache, jobs=8, prefetch=True):
         self.channels = channels
-        self.start = start
-        self.end = end
+        # the grid is drawn on half-hour boundaries; keeping the window
+        # aligned lets navigation and drawing share the same listings
+        self.start = align_time(start)
+        self.end = align_time(end)
         self.cache = cache
-
+        self.jobs = jobs
+
+        # memoized get_program_listings() results, keyed on the window and
+        # the channel-days loaded when they were computed
+        self._listings = {}
+        self.loaded = self.loaded_days()
+        self.listings_hits = 0
+        self.listings_misses = 0
+        # set by the prefetcher when a day has been loaded in the background
+        self._stale = False
+        self.prefetcher = Prefetcher(cache, jobs, self._prefetched) if prefetch else None
+
+        self.screen = Screen()
         self.columns, self.rows = shutil.get_terminal_size((80, 24))
         self.info = "-- QUICK XMLTV --".center(self.columns)
         self.highlight = None
@@ -256,7 +371,51 @@ class EPG:
 
     @property
     def listings(self):
-        return get_program_listings(self.channels, self.start, self.end)
+        return self.get_listings(self.start, self.end)
+
+    def get_listings(self, start=None, end=None):
+        if self._stale:
+            self._stale = False
+            self.refresh_loaded()
+        key = (start, end, self.loaded)
+        if key in self._listings:
+            self.listings_hits += 1
+        else:
+            self.listings_misses += 1
+            self._listings[key] = get_program_listings(self.channels, start, end)
+        return self._listings[key]
+
+    def invalidate(self):
+        self._listings.clear()
+
+    def stats(self):
+        return {
+            "listings_hits": self.listings_hits,
+            "listings_misses": self.listings_misses,
+        }
+
+    def loaded_days(self):
+        return frozenset((ch.id, iso) for ch in self.channels for iso in ch.loaded())
+
+    def refresh_loaded(self):
+        loaded = self.loaded_days()
+        if loaded != self.loaded:
+            self.loaded = loaded
+            self.invalidate()
+
+    def _prefetched(self, ch, d):
+        self._stale = True
+
+    # Starts loading the days either side of the window (and either side
+    # of the current time, for the next/previous day jumps) in the
+    # background.
+    def prefetch(self):
+        if self.prefetcher is None:
+            return
+        day = timedelta(1, 0)
+        dates = { self.start.date() - day, self.end.date() + day,
+                  self.curr_time.date() - day, self.curr_time.date() + day }
+        self.prefetcher.want(self.channels, dates)
 
     def reset(self):
         listings = self.listings
@@ -307,41 +466,52 @@ class EPG:
         self.end += interval * dir
         self.start += interval * dir
         self._last_time_travel = now
+        self.invalidate()
 
     def jump(self, dt):
-        get_full_listings = lambda: get_program_listings(self.channels)
+        get_full_listings = lambda: self.get_listings()
+        self.invalidate()
         self.curr_time = dt
         self.highlight = self.find_closest(self.highlight.channel, get_listings=get_full_listings)
         self.update_time()
 
     def _epg_update(self):
-        print_epg(self.channels, self.start, self.end, self.highlight)
-        print("")
-        print(self.info)
-        print("")
-        print("Jump: ([R]ight now, [N]ext day, [P]revious day), [Q]uit: ")
+        columns, rows = shutil.get_terminal_size((80, 24))
+        lines = render_epg(self.channels, self.start, self.end, self.highlight, get_listings=self.get_listings, columns=columns)
+        info = []
+        for line in self.info.split("\n"):
+            info += textwrap.wrap(line, columns) if len(line) > columns else [line]
+        return lines + [""] + info + ["", "Jump: ([R]ight now, [N]ext day, [P]revious day), [Q]uit: "]
 
     def _opt_update(self):
-        pass
+        return []
 
     def _chan_update(self):
-        pass
+        return []
 
     def fetch(self, d):
+        missing = [ch for ch in self.channels if d.isoformat() not in ch.programs]
+        if not missing:
+            return
+
         try:
-            for ch in self.channels:
-                if d.isoformat() not in ch.programs:
-                    with Progress("Loading program information for {}".format(ch.id)):
-                        ch.fetch(d, self.cache)
-        except HTTPError as e:
-            print("Failed to load program information.")
+            with Progress("Loading program information for {}".format(d.isoformat())):
+                fetch_programs(missing, [d], self.cache, jobs=self.jobs, quiet=True)
+        # leave the alternate screen before reporting, or the error is lost
+        # with it
+        except Exception as e:
+            self.close()
+            print("Failed to load program information: ", file=sys.stderr)
             abort(e)
 
+        # the progress message was written over the last frame
+        self.screen.invalidate()
+        self.refresh_loaded()
+
     def update_time(self):
-        align = lambda dt, align=60*30: datetime.fromtimestamp(floor(dt.timestamp() / align) * align)
-        while self.highlight.start >= align(self.end) or self.curr_time > align(self.end):
+        while self.highlight.start >= align_time(self.end) or self.curr_time > align_time(self.end):
             self.time_travel(self.FORWARDS,  timeout=0)
-        while self.highlight.end <= align(self.start) or self.curr_time < align(self.start):
+        while self.highlight.end <= align_time(self.start) or self.curr_time < align_time(self.start):
             self.time_travel(self.BACKWARDS, timeout=0)
 
         for ch in self.channels:
@@ -351,13 +521,18 @@ class EPG:
             if len(list(filter(lambda p: self.start >= p.start, self.listings[ch.id]))) == 0:
                 self.fetch((self.start - timedelta(1, 0)).date())
 
+    @perf.timed("epg.update")
     def update(self):
         self.update_time()
-        clear()
 
-        if self.mode == self.MODE_EPG: self._epg_update()
-        elif self.mode == self.MODE_OPTIONS: self._opt_update()
-        elif self.mode == self.MODE_CHANNELS: self._chan_update()
+        if self.mode == self.MODE_EPG: lines = self._epg_update()
+        elif self.mode == self.MODE_OPTIONS: lines = self._opt_update()
+        elif self.mode == self.MODE_CHANNELS: lines = self._chan_update()
+        with perf.span("screen.draw"):
+            self.screen.draw(lines)
+        perf.count("epg.frames")
+
+        self.prefetch()
 
     def _epg_listener(self, ch):
         matches = lambda c: ch.lower().startswith(c.lower())
@@ -394,6 +569,11 @@ class EPG:
             self.info = self.highlight.info()
 
         elif check('q'):
+            self.close()
+            if self.cache.verbose:
+                stats = dict(self.screen.stats(), **self.stats())
+                for key, value in stats.items():
+                    print("{}: {}".format(key, value))
             exit(0)
 
         elif check('o'):
@@ -410,6 +590,13 @@ class EPG:
 
         self.update()
 
+    # Stops prefetching (without waiting for the days queued) and leaves
+    # the alternate screen.
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+        self.screen.close()
+
     def _opt_listener(self, ch):
         pass
 
@@ -421,6 +608,7 @@ class EPG:
             ch = getch()
         except KeyboardInterrupt:
             exit(0)
+        self.screen.input()
 
         if ch == "\033":
             try:
@@ -440,6 +628,7 @@ class EPG:
             except KeyboardInterrupt:
                 exit(0)
 
-        if self.mode == self.MODE_EPG: self._epg_listener(ch)
-        elif self.mode == self.MODE_OPTIONS: self._opt_listener(ch)
-        elif self.mode == self.MODE_CHANNELS: self._chan_listener(ch)
+        with perf.span("epg.key"):
+            if self.mode == self.MODE_EPG: self._epg_listener(ch)
+            elif self.mode == self.MODE_OPTIONS: self._opt_listener(ch)
+            elif self.mode == self.MODE_CHANNELS: self._chan_listener(ch)
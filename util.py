@@ -2,10 +2,13 @@
 
 import os
 import sys
+import atexit
 import shutil
 import threading
 import traceback
-from time import sleep
+from time import sleep, perf_counter
+from math import floor
+from itertools import groupby
 from datetime import time, date, datetime, timedelta
 
 class ansi:
@@ -38,10 +41,78 @@ class ansi:
     BG_CYAN    = "\033[46m"
     BG_WHITE   = "\033[47m"
 
+class CellLine:
+    """A line of text laid out in fixed-width cells.
+
+        Each cell holds one character and a style: an ANSI escape sequence,
+        or "" for the terminal's default. Text and styles are kept apart
+        while the line is laid out; escape sequences are only produced by
+        render(), where the style changes.
+    """
+    def __init__(self, width, fillchar=" "):
+        self.width = width
+        self.chars = [fillchar] * width
+        self.styles = [""] * width
+
+    # Writes text starting at the given cell, clipped to the line.
+    # Returns the cell after the last one written.
+    def write(self, start, text, style=None):
+        start = max(start, 0)
+        if start >= self.width:
+            return self.width
+        end = min(start + len(text), self.width)
+        self.chars[start:end] = text[:end - start]
+        if style is not None:
+            self.styles[start:end] = [style] * (end - start)
+        return end
+
+    def style(self, start, end, style):
+        start, end = max(start, 0), min(end, self.width)
+        if start < end:
+            self.styles[start:end] = [style] * (end - start)
+
+    # Returns the first cell from start (up to end) holding char, or -1.
+    def find(self, char, start=0, end=None):
+        try:
+            return self.chars.index(char, max(start, 0), self.width if end is None else end)
+        except ValueError:
+            return -1
+
+    # With close=False a style still active at the end of the line is left
+    # for the caller to reset.
+    def render(self, close=True):
+        out = []
+        i = 0
+        current = ""
+        for style, run in groupby(self.styles):
+            n = len(list(run))
+            if style != current:
+                out.append(ansi.RESET if current else "")
+                out.append(style)
+                current = style
+            out.append("".join(self.chars[i:i+n]))
+            i += n
+        if current and close:
+            out.append(ansi.RESET)
+        return "".join(out)
+
+    def __str__(self):
+        return "".join(self.chars)
+
 def abort(msg):
-    print(str(msg))
+    print(str(msg), file=sys.stderr)
     sys.exit(1)
 
+# Calls fn, exiting quietly if standard output is closed before it is done
+# writing (e.g. when piped into `head`).
+def quiet_pipe(fn, *args, **kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except BrokenPipeError:
+        # don't complain again when standard output is flushed at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
 def sensible_input(prompt):
     try:
         return input(prompt)
@@ -66,6 +137,114 @@ def clear():
     os.system(cmd)
     print("\033[3J\033c", end='')
 
+class Screen:
+    """A terminal screen that is redrawn differentially.
+
+        The screen remembers the last frame it drew, and draw() only
+        rewrites the lines that changed, moving to each with a cursor
+        addressing sequence. The whole screen is repainted on the first
+        frame, when the terminal is resized, or after invalidate() (e.g.
+        when something else has written to the terminal). Frames are drawn
+        on the alternate screen buffer, which is left at exit.
+    """
+    ALT_SCREEN  = "\033[?1049h"
+    MAIN_SCREEN = "\033[?1049l"
+    CLEAR       = "\033[H\033[2J"
+    CLEAR_LINE  = "\033[K"
+    MOVE        = "\033[{};1H"
+
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self.lines = None
+        self.size = None
+        self.active = False
+
+        self.frames = 0
+        self.repaints = 0
+        self.bytes_written = 0
+        self.last_bytes = 0
+        self.inputs = 0
+        self.last_latency = None
+        self.total_latency = 0
+        self._input_time = None
+
+    def open(self):
+        if not self.active:
+            self.active = True
+            self.lines = None
+            self.write(self.ALT_SCREEN)
+            atexit.register(self.close)
+
+    def close(self):
+        if self.active:
+            self.active = False
+            self.write(self.MAIN_SCREEN)
+            atexit.unregister(self.close)
+
+    def invalidate(self):
+        self.lines = None
+
+    # Marks the time input was received, so the latency to the next frame
+    # can be measured.
+    def input(self):
+        self._input_time = perf_counter()
+
+    # Draws a frame, leaving the cursor at the given (row, column), or
+    # below the frame.
+    def draw(self, lines, cursor=None):
+        self.open()
+        size = shutil.get_terminal_size((80, 24))
+        # like scrolling would, keep the bottom of a frame taller than the
+        # terminal (and a row for the cursor)
+        if len(lines) >= size[1]:
+            lines = lines[len(lines) - size[1] + 1:]
+        out = []
+        if self.lines is None or size != self.size:
+            self.repaints += 1
+            out.append(self.CLEAR)
+            for row, line in enumerate(lines):
+                out.append(self.MOVE.format(row + 1) + line)
+        else:
+            for row, line in enumerate(lines):
+                if row >= len(self.lines) or self.lines[row] != line:
+                    # clear before writing: clearing after a line as wide as
+                    # the terminal would erase its last column
+                    out.append(self.MOVE.format(row + 1) + self.CLEAR_LINE + line)
+            for row in range(len(lines), len(self.lines)):
+                out.append(self.MOVE.format(row + 1) + self.CLEAR_LINE)
+        if cursor is None:
+            # below the frame, where print() would have left it
+            out.append(self.MOVE.format(len(lines) + 1))
+        else:
+            out.append("\033[{};{}H".format(cursor[0] + 1, cursor[1] + 1))
+
+        self.lines = list(lines)
+        self.size = size
+        self.last_bytes = self.write("".join(out))
+        self.frames += 1
+        if self._input_time is not None:
+            self.last_latency = perf_counter() - self._input_time
+            self.inputs += 1
+            self.total_latency += self.last_latency
+            self._input_time = None
+
+    def write(self, data):
+        n = len(data.encode(getattr(self.out, "encoding", None) or "utf-8", "replace"))
+        self.out.write(data)
+        self.out.flush()
+        self.bytes_written += n
+        return n
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "repaints": self.repaints,
+            "bytes_written": self.bytes_written,
+            "bytes_per_frame": self.bytes_written // self.frames if self.frames else 0,
+            "last_latency_ms": round(self.last_latency * 1000, 2) if self.last_latency is not None else None,
+            "mean_latency_ms": round(self.total_latency * 1000 / self.inputs, 2) if self.inputs else None,
+        }
+
 def timestr_to_delta(timestr):
     if isinstance(timestr, timedelta):
         return timestr
@@ -86,6 +265,10 @@ def timestr_to_time(timestr):
     time_parts = timestr.split(":")
     return time(int(time_parts[0]), int(time_parts[1]), int(time_parts[2] if len(time_parts) > 2 else 0))
 
+# Rounds a datetime down to a multiple of the given interval (in seconds).
+def align_time(dt, interval=60*30):
+    return datetime.fromtimestamp(floor(dt.timestamp() / interval) * interval)
+
 def iso_to_datetime(iso):
     if isinstance(iso, datetime):
         return iso
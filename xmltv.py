@@ -1,52 +1,176 @@
 #!/usr/bin/python3
 
+import sys
 import gzip
+import json
+import heapq
 import random
+import threading
 import traceback
 import xml.dom.minidom as MD
+from difflib import SequenceMatcher
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import xml.etree.ElementTree as ET
 from urllib.parse import urljoin
 from urllib.error import HTTPError
 from time import timezone as curr_tz
 from datetime import datetime, date, time, timedelta
 
+import perf
 from util import *
 
 class TVChannel:
-    def __init__(self, element, programs=[]):
-        self.element = element
-        self.id = element.getAttribute("id")
-        self.display_name = inner_text(element.getElementsByTagName("display-name")[0])
-        self.base_url = inner_text(random.choice(element.getElementsByTagName("base-url")))
-        self.dates = [inner_text(e) for e in element.getElementsByTagName("datafor")]
+    # The name of the PROGRAM_PARSERS entry used by fetch() by default.
+    parser = "iterparse"
+
+    def __init__(self, id, display_name, base_urls, dates=[], modified=None):
+        self.id = id
+        self.display_name = display_name
+        self.base_urls = base_urls
+        self.base_url = random.choice(base_urls)
+        self.dates = list(dates)
+        # the last modified stamp of each date's listing, as given by the
+        # channel directory
+        self.modified = dict(modified or {})
 
         self.programs = {}
-
-    def fetch(self, d, cache):
+        self.index = ProgramIndex()
+        # guards programs/index; _pending holds an Event for each day
+        # that is being fetched by some thread
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    # Builds a channel from a <channel> element of the channel directory.
+    # Only the values needed later are kept, so the element can be
+    # discarded straight afterwards.
+    def from_element(element):
+        display_name = element.find("display-name")
+        datafor = [("".join(e.itertext()), e.get("lastmodified")) for e in element.iter("datafor")]
+        return TVChannel(element.get("id"),
+                         "".join(display_name.itertext()) if display_name is not None else "",
+                         ["".join(e.itertext()) for e in element.iter("base-url")],
+                         [iso for iso, stamp in datafor],
+                         { iso: stamp for iso, stamp in datafor if stamp })
+
+    # Loads the programs for the given date into self.programs, unless
+    # they are already loaded. Safe to call from several threads at once;
+    # concurrent calls for the same date wait for a single download, and
+    # try again themselves if it fails. If quiet, errors are raised rather
+    # than reported.
+    @perf.timed("channel.fetch")
+    def fetch(self, d, cache, parser=None, quiet=False):
         if isinstance(d, str):
             d = datestr_to_date(d)
 
         iso = d.isoformat()
-        if iso not in self.programs:
-            self.programs[iso] = []
-
-        if len(self.programs[iso]) == 0:
-            if len(self.dates) > 0 and iso not in self.dates:
-                return None
-            try:
-                content = cache.fetch(urljoin(self.base_url, "{}_{}.xml.gz".format(self.id, iso)))
-                decomp = gzip.decompress(content)
-                dom = MD.parseString(decomp).documentElement
-            except HTTPError as e:
-                if e.code == 404:
-                    return None
+        with self._lock:
+            if self.programs.get(iso):
+                return
+            pending = self._pending.get(iso)
+            if pending is None:
+                self._pending[iso] = threading.Event()
+
+        if pending is not None:
+            pending.wait()
+            if iso not in self.programs:
+                self.fetch(d, cache, parser, quiet)
+            return
+
+        # a failed load is not recorded, so the date is fetched again when
+        # it is next wanted
+        try:
+            programs = []
+            if len(self.dates) == 0 or iso in self.dates:
+                programs = self.load(d, cache, parser, quiet) or []
+            with self._lock:
+                self.programs[iso] = programs
+                self.index.add(programs)
+        finally:
+            with self._lock:
+                self._pending.pop(iso).set()
+
+    # Loads the programs for the given date again, replacing those loaded
+    # before if the listing has changed. Returns whether it had. If quiet,
+    # errors are raised rather than reported.
+    def refresh(self, d, cache, parser=None, quiet=False):
+        iso = d.isoformat()
+        if len(self.dates) != 0 and iso not in self.dates:
+            return False
+        programs = self.load(d, cache, parser, quiet) or []
+        with self._lock:
+            old = self.programs.get(iso) or []
+            if [p.to_tuple() for p in old] == [p.to_tuple() for p in programs]:
+                return False
+            self.programs[iso] = programs
+            self._reindex()
+        return True
+
+    # Drops the programs loaded for the given date.
+    def unload(self, d):
+        iso = d.isoformat() if isinstance(d, date) else d
+        with self._lock:
+            if self.programs.pop(iso, None):
+                self._reindex()
+
+    # Replaces the index with one built from the loaded programs. The old
+    # index is left intact for anyone still reading it.
+    def _reindex(self):
+        index = ProgramIndex()
+        index.add([p for iso in sorted(self.programs) for p in self.programs[iso]])
+        self.index = index
+
+    def listing_url(self, d):
+        return urljoin(self.base_url, "{}_{}.xml.gz".format(self.id, d.isoformat()))
+
+    # Downloads and parses the programs for the given date, returning them
+    # as a list (or None if there is no listing for that date). If the
+    # listing is unchanged since it was last parsed, the programs are read
+    # from its snapshot instead. A listing cached under the same last
+    # modified stamp as the channel directory gives is not requested at
+    # all. If quiet, errors are raised rather than reported.
+    def load(self, d, cache, parser=None, quiet=False):
+        parser = PROGRAM_PARSERS[parser or self.parser]
+        url = self.listing_url(d)
+        try:
+            # listings for past days are not updated any more
+            max_age = PAST_LISTINGS_MAX_AGE if d < date.today() else None
+            with perf.span("listing.request"):
+                fp = cache.fetch_stream(url, max_age=max_age, version=self.modified.get(d.isoformat()))
+            with fp:
+                with perf.span("listing.snapshot_load"):
+                    programs = load_snapshot(cache, url, fp.sha1sum)
+                if programs is None:
+                    # parse the listing as it is downloaded
+                    source = perf.timed_reader(fp, "listing.read" if fp.from_cache else "listing.download")
+                    with perf.span("listing.parse"), gzip.GzipFile(fileobj=source) as gz:
+                        programs = list(parser(gz))
+                    fp.read()
+                    with perf.span("listing.snapshot_save"):
+                        save_snapshot(cache, url, fp.sha1sum, programs)
+                    perf.count("programs.parsed", len(programs))
                 else:
-                    print("Error when retrieving program info: ")
-                    abort(e)
-            except Exception as e:
-                print("Error when retrieving program info: ")
-                abort(e)
-
-            self.programs[iso] = [TVProgram(e) for e in dom.getElementsByTagName("programme")]
+                    perf.count("programs.from_snapshot", len(programs))
+            return programs
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            if quiet:
+                raise
+            print("Error when retrieving program info: ", file=sys.stderr)
+            abort(e)
+        except Exception as e:
+            if quiet:
+                raise
+            print("Error when retrieving program info: ", file=sys.stderr)
+            abort(e)
+
+    # Returns the dates (as ISO strings) that have programs loaded.
+    def loaded(self):
+        with self._lock:
+            return [iso for iso in self.programs if self.programs[iso]]
 
     def matches(self, query):
         query = query.lower()
@@ -55,8 +179,50 @@ class TVChannel:
     def __str__(self):
         return "{}: {}".format(self.id, self.display_name)
 
+# How long (in seconds) the channel directory and listings for past days
+# are used from the cache before checking for a newer copy. The directory
+# is always checked: its last modified stamps decide which listings are
+# used from the cache without a request.
+CHANNELS_MAX_AGE = 0
+PAST_LISTINGS_MAX_AGE = 7*24*60*60
+
+# Stored program times are counted from this (local) time.
+EPOCH = datetime(1970, 1, 1)
+
+# Listing times are local and naive; these count seconds of local time.
+def to_seconds(dt):
+    return int((dt - EPOCH).total_seconds())
+
+def from_seconds(t):
+    return EPOCH + timedelta(0, t)
+
+# Maps XMLTV timezone offsets ("+1000") to the difference between that
+# timezone and local time.
+TZ_OFFSETS = {}
+
 class TVProgram:
+    # Parses an XMLTV timestamp into a (local) datetime.
     def parseTimestamp(ts, ignore_timezone=False):
+        # fast path for the full "YYYYMMDDHHMMSS +ZZZZ" form used by
+        # nearly every listing
+        if ts and len(ts) == 20 and ts[14] == " ":
+            d = datetime(int(ts[0:4]), int(ts[4:6]), int(ts[6:8]),
+                         int(ts[8:10]), int(ts[10:12]), int(ts[12:14]))
+            # the offset is read even if ignored, so that malformed ones
+            # are rejected as they are by the general parser
+            tz = ts[15:]
+            offset = TZ_OFFSETS.get(tz)
+            if offset is None:
+                sign = -1 if tz[0] == "-" else 1
+                offset = timedelta(0, sign * (int(tz[1:3])*60 + int(tz[3:5]))*60 + curr_tz, 0)
+                TZ_OFFSETS[tz] = offset
+            return d if ignore_timezone else d + offset
+
+        return TVProgram.parsePartialTimestamp(ts, ignore_timezone)
+
+    # Parses an XMLTV timestamp of any precision, taking any fields that
+    # are left out from the current date.
+    def parsePartialTimestamp(ts, ignore_timezone=False):
         timestamp = ""
         timezone = -curr_tz
         if ts == None or len(ts) == 0:
@@ -100,7 +266,29 @@ class TVProgram:
         return calc()
 
 
-    def __init__(self, element):
+    __slots__ = ("title", "sub_title", "description", "actors", "director", "date",
+                 "categories", "rating", "start", "end", "channel")
+
+    def __init__(self, title="???", sub_title=None, description=None, actors=(),
+                 director=None, date=None, categories=(), rating=None,
+                 start=None, end=None, channel=None):
+        now = datetime.now()
+        self.title       = title
+        self.sub_title   = sub_title
+        self.description = description
+        self.actors      = tuple(actors)
+        self.director    = director
+        self.date        = date
+        # values repeated across most programs share a single string object
+        self.categories  = tuple(map(sys.intern, categories))
+        self.rating      = sys.intern(rating) if rating else rating
+
+        self.start       = start or now
+        self.end         = end or now
+        self.channel     = sys.intern(channel) if channel else channel
+
+    # Builds a program from a minidom <programme> element.
+    def from_dom(element):
         def get_tag(tag, el=element):
             res = el.getElementsByTagName(tag)
             if len(res) == 0:
@@ -113,27 +301,114 @@ class TVProgram:
             return inner_text(tags[0]) or default
         list_tag = lambda tag, el=element: [inner_text(e) for e in el.getElementsByTagName(tag)]
 
-        now = datetime.now()
-        self.element     = element
-        self.title       = text_tag("title", default="???")
-        self.sub_title   = text_tag("sub-title")
-        self.description = text_tag("desc")
-        self.actors      = list_tag("actor", el=get_tag("credits"))
-        self.director    = text_tag("director", el=get_tag("credits"))
         d = text_tag("date")
-        self.date        = TVProgram.parseTimestamp(d) if d else None
-        self.categories  = list_tag("category")
-        self.rating      = text_tag("value", el=get_tag("rating"))
-
-        self.start       = TVProgram.parseTimestamp(element.getAttribute("start"), ignore_timezone=True) or now
-        self.end         = TVProgram.parseTimestamp(element.getAttribute("stop"), ignore_timezone=True) or now
-        self.channel     = element.getAttribute("channel")
+        return TVProgram(
+            title       = text_tag("title", default="???"),
+            sub_title   = text_tag("sub-title"),
+            description = text_tag("desc"),
+            actors      = list_tag("actor", el=get_tag("credits")),
+            director    = text_tag("director", el=get_tag("credits")),
+            date        = TVProgram.parseTimestamp(d) if d else None,
+            categories  = list_tag("category"),
+            rating      = text_tag("value", el=get_tag("rating")),
+            start       = TVProgram.parseTimestamp(element.getAttribute("start"), ignore_timezone=True),
+            end         = TVProgram.parseTimestamp(element.getAttribute("stop"), ignore_timezone=True),
+            channel     = element.getAttribute("channel"))
+
+    # Builds a program from an ElementTree <programme> element, visiting
+    # each child (and the children of <credits> and <rating>) only once.
+    def from_element(element):
+        text = lambda el: "".join(el.itertext())
+        fields = { "actors": [], "categories": [] }
+        has_credits = has_rating = False
+        for child in element:
+            tag = child.tag
+            if tag == "title":
+                fields.setdefault("title", text(child) or "???")
+            elif tag == "sub-title":
+                fields.setdefault("sub_title", text(child) or None)
+            elif tag == "desc":
+                fields.setdefault("description", text(child) or None)
+            elif tag == "date":
+                fields.setdefault("date", TVProgram.parseTimestamp(text(child)) if text(child) else None)
+            elif tag == "category":
+                fields["categories"].append(text(child))
+            elif tag == "credits":
+                has_credits = True
+                for credit in child:
+                    if credit.tag == "actor":
+                        fields["actors"].append(text(credit))
+                    elif credit.tag == "director":
+                        fields.setdefault("director", text(credit) or None)
+            elif tag == "rating":
+                has_rating = True
+                for value in child.iter("value"):
+                    fields.setdefault("rating", text(value) or None)
+
+        # Without <credits> or <rating>, the minidom parser searches the
+        # whole programme instead; match it for these (rare) documents.
+        if not has_credits:
+            fields["actors"] = [text(e) for e in element.iter("actor")]
+            director = next(element.iter("director"), None)
+            if director is not None:
+                fields["director"] = text(director) or None
+        if not has_rating:
+            value = next(element.iter("value"), None)
+            if value is not None:
+                fields["rating"] = text(value) or None
+
+        return TVProgram(
+            start   = TVProgram.parseTimestamp(element.get("start"), ignore_timezone=True),
+            end     = TVProgram.parseTimestamp(element.get("stop"), ignore_timezone=True),
+            channel = element.get("channel", ""),
+            **fields)
 
     def __str__(self):
         return "{} [{} - {}]".format(self.title.upper(), self.start.strftime("%H:%M"), self.end.strftime("%H:%M"))
 
+    def key(self):
+        return (self.channel, self.start, self.end, self.title)
+
+    def to_tuple(self):
+        return tuple(getattr(self, name) for name in TVProgram.__slots__)
+
+    # Returns the program's fields as plain values that can be stored as
+    # JSON, with its times as (local) seconds since the epoch.
+    def to_record(self):
+        epoch = lambda dt: to_seconds(dt) if dt is not None else None
+        return [self.title, self.sub_title, self.description, self.actors, self.director, epoch(self.date),
+                self.categories, self.rating, epoch(self.start), epoch(self.end), self.channel]
+
+    def from_record(record):
+        title, sub_title, description, actors, director, d, categories, rating, start, end, channel = record
+        return TVProgram(title, sub_title, description, actors, director,
+                         from_seconds(d) if d is not None else None, categories, rating,
+                         from_seconds(start), from_seconds(end), channel)
+
+    # Returns the program's fields as plain (JSON serialisable) values.
+    def to_dict(self):
+        iso = lambda dt: dt.isoformat() if dt is not None else None
+        return {
+            "channel":     self.channel,
+            "start":       iso(self.start),
+            "end":         iso(self.end),
+            "title":       self.title,
+            "sub_title":   self.sub_title,
+            "description": self.description,
+            "date":        self.date.strftime("%Y") if self.date is not None else None,
+            "director":    self.director,
+            "actors":      list(self.actors),
+            "categories":  list(self.categories),
+            "rating":      self.rating,
+        }
+
     def __eq__(self, other):
-        return other.element == self.element
+        if not isinstance(other, TVProgram):
+            return NotImplemented
+        return self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
 
     def info(self):
         s = ""
@@ -163,28 +438,328 @@ class TVProgram:
 
         return s
 
-def parse_channels(channel_url, cache):
+# Yields a TVChannel for each <channel> element in the (uncompressed)
+# channel directory read from fp. The document is parsed incrementally and
+# each element is released once its channel has been built, so no tree is
+# kept around.
+def iter_channels(fp):
+    root = None
+    for event, el in ET.iterparse(fp, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = el
+            continue
+        if el.tag == "channel":
+            yield TVChannel.from_element(el)
+            el.clear()
+            root.clear()
+
+# A read-only slice of a ProgramIndex, returned by window queries.
+# It refers to the index's lists rather than copying them; an index never
+# modifies its lists in place, so the view stays valid after more
+# programs are added.
+class ListingView(Sequence):
+    def __init__(self, programs, starts, lo=0, hi=None):
+        self.programs = programs
+        self.starts = starts
+        self.lo = lo
+        self.hi = len(programs) if hi is None else hi
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.programs[self.lo + j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("listing index out of range")
+        return self.programs[self.lo + i]
+
+    def __iter__(self):
+        for i in range(self.lo, self.hi):
+            yield self.programs[i]
+
+    def index(self, prog, start=0, stop=None):
+        stop = len(self) if stop is None else stop
+        i = bisect_left(self.starts, prog.start, self.lo + start, self.lo + stop)
+        while i < self.lo + stop and self.starts[i] == prog.start:
+            if self.programs[i] == prog:
+                return i - self.lo
+            i += 1
+        raise ValueError("{} is not in listing".format(prog))
+
+    def __contains__(self, prog):
+        try:
+            self.index(prog)
+            return True
+        except ValueError:
+            return False
+
+    def __repr__(self):
+        return "ListingView({!r})".format(list(self))
+
+# The programs of a channel sorted by start time, for fast window queries.
+class ProgramIndex:
+    def __init__(self):
+        self.programs = []
+        self.starts = []
+        # running maximum of the programs' end times, which (unlike the end
+        # times themselves) is guaranteed to be sorted
+        self.max_ends = []
+        # whether any program ends before an earlier-starting one does
+        self.nested = False
+
+    def add(self, programs):
+        if not programs:
+            return
+        merged = sorted(self.programs + list(programs), key=lambda p: p.start)
+        starts, max_ends, nested = [], [], False
+        for p in merged:
+            if max_ends and p.end <= max_ends[-1]:
+                nested = True
+            starts.append(p.start)
+            max_ends.append(max(p.end, max_ends[-1]) if max_ends else p.end)
+        self.programs, self.starts, self.max_ends, self.nested = merged, starts, max_ends, nested
+
+    def __len__(self):
+        return len(self.programs)
+
+    # Returns the programs that overlap the given window, or all of them
+    # if the window is not fully given.
+    def window(self, start=None, end=None):
+        programs, starts = self.programs, self.starts
+        if start is None or end is None:
+            return ListingView(programs, starts)
+
+        lo = bisect_right(self.max_ends, start)
+        hi = max(lo, bisect_left(starts, end))
+        if self.nested:
+            # a program inside a longer one may end before the window
+            # starts even though it lies after lo; filter those out
+            progs = [p for p in programs[lo:hi] if p.end > start]
+            if len(progs) != hi - lo:
+                return ListingView(progs, [p.start for p in progs])
+        return ListingView(programs, starts, lo, hi)
+
+# Yields a TVProgram for each <programme> in the (uncompressed) listing
+# read from fp, in a single incremental pass over the document.
+def iter_programs(fp):
+    root = None
+    for event, el in ET.iterparse(fp, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = el
+            continue
+        if el.tag == "programme":
+            yield TVProgram.from_element(el)
+            el.clear()
+            root.clear()
+
+# Yields a TVProgram for each <programme> in the listing read from fp,
+# building the full minidom tree first. Slower, but kept as a fallback.
+def iter_programs_dom(fp):
+    dom = MD.parse(fp).documentElement
+    for e in dom.getElementsByTagName("programme"):
+        yield TVProgram.from_dom(e)
+
+# Parsed programs are kept next to each cached listing, tagged with the
+# sha1sum of the listing they came from, so that unchanged listings do not
+# need to be parsed again. They are stored as JSON, so that reading a
+# snapshot from a shared cache directory cannot run code.
+SNAPSHOT_EXT = "programs"
+SNAPSHOT_VERSION = 2
+
+def load_snapshot(cache, url, sha1sum):
+    if not sha1sum:
+        return None
+    try:
+        with cache.open_aux(url, SNAPSHOT_EXT, "rb") as fp:
+            version, snapshot_sum, records = json.load(fp)
+        if version != SNAPSHOT_VERSION or snapshot_sum != sha1sum:
+            return None
+        return [TVProgram.from_record(r) for r in records]
+    except Exception:
+        return None
+
+def save_snapshot(cache, url, sha1sum, programs):
+    if not sha1sum:
+        return
+    records = [p.to_record() for p in programs]
     try:
-        content = cache.fetch(channel_url)
-        decomp = gzip.decompress(content)
-        dom = MD.parseString(decomp).documentElement
+        cache.save_aux(url, SNAPSHOT_EXT, json.dumps([SNAPSHOT_VERSION, sha1sum, records],
+                                                     separators=(",", ":")).encode())
+    except OSError:
+        pass
+
+PROGRAM_PARSERS = {
+    "iterparse": iter_programs,
+    "minidom": iter_programs_dom
+}
+
+# Fetches the programs of every channel for every date given, running up
+# to `jobs` downloads at once. Days are parsed as their downloads finish;
+# callback(chan, d) is called (from this thread) after each one. If quiet,
+# errors are raised rather than reported.
+def fetch_programs(channels, dates, cache, jobs=8, callback=None, quiet=False):
+    pool = ThreadPoolExecutor(max_workers=max(jobs, 1))
+    try:
+        futures = {}
+        for chan in channels:
+            for d in dates:
+                futures[pool.submit(chan.fetch, d, cache, quiet=quiet)] = (chan, d)
+        for future in as_completed(futures):
+            future.result()
+            if callback is not None:
+                callback(*futures[future])
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+class ChannelDirectory(dict):
+    """The channels of a directory, keyed by id, with a search index.
+
+        Every substring of up to GRAM characters of each channel's id and
+        display name is indexed, so a short query is answered by a single
+        lookup and a longer one by intersecting the sets of its GRAM-long
+        substrings. Misspelt queries are compared with the words of the
+        directory that share the most pairs of letters with them.
+    """
+    GRAM = 3
+    FUZZY_CANDIDATES = 50
+    FUZZY_CUTOFF = 0.7
+
+    def __init__(self, channels=()):
+        super().__init__()
+        self.grams = {}
+        self.fields = {}
+        self.words = {}
+        self.word_grams = {}
+        for chan in channels:
+            self.add(chan)
+
+    @classmethod
+    def ngrams(cls, text, sizes=None):
+        sizes = sizes or range(1, cls.GRAM + 1)
+        return { text[i:i+n] for n in sizes for i in range(len(text) - n + 1) }
+
+    @staticmethod
+    def split_words(name_id, name):
+        return frozenset(name_id.replace(".", " ").split() + name.split())
+
+    def add(self, chan):
+        self[chan.id] = chan
+
+    def __setitem__(self, id, chan):
+        if id in self:
+            del self[id]
+        super().__setitem__(id, chan)
+        name_id, name = id.lower(), chan.display_name.lower()
+        words = self.split_words(name_id, name)
+        # the words, each following a "\0", for finding word prefixes
+        self.fields[id] = (name_id, name, words, "".join("\0" + word for word in words))
+        for gram in self.ngrams(name_id) | self.ngrams(name):
+            self.grams.setdefault(gram, set()).add(id)
+        for word in words:
+            if word not in self.words:
+                self.words[word] = set()
+                for gram in self.ngrams(word, [2]):
+                    self.word_grams.setdefault(gram, set()).add(word)
+            self.words[word].add(id)
+
+    def __delitem__(self, id):
+        super().__delitem__(id)
+        name_id, name, words, _ = self.fields.pop(id)
+        for gram in self.ngrams(name_id) | self.ngrams(name):
+            discard(self.grams, gram, id)
+        for word in words:
+            if discard(self.words, word, id):
+                for gram in self.ngrams(word, [2]):
+                    discard(self.word_grams, gram, word)
+
+    # Returns the ids of channels whose id or display name contains query
+    # (which is already lower case).
+    def _substring(self, query):
+        if len(query) <= self.GRAM:
+            return self.grams.get(query, set())
+        postings = [self.grams.get(gram, set()) for gram in self.ngrams(query, [self.GRAM])]
+        postings.sort(key=len)
+        candidates = set.intersection(*postings)
+        return { id for id in candidates if query in self.fields[id][0] or query in self.fields[id][1] }
+
+    def _rank(self, id, query):
+        name_id, name, words, joined = self.fields[id]
+        if query == name_id or query == name: return 0
+        if name_id.startswith(query) or name.startswith(query): return 1
+        if "\0" + query in joined: return 2
+        return 3
+
+    # Returns the ids of channels with a word close to query, with how
+    # close the closest is.
+    def _fuzzy(self, query):
+        counts = Counter()
+        for gram in self.ngrams(query, [2]):
+            counts.update(self.word_grams.get(gram, ()))
+        matcher = SequenceMatcher(b=query)
+        matches = {}
+        for word, n in counts.most_common(self.FUZZY_CANDIDATES):
+            matcher.set_seq1(word)
+            if matcher.real_quick_ratio() < self.FUZZY_CUTOFF or matcher.quick_ratio() < self.FUZZY_CUTOFF:
+                continue
+            score = matcher.ratio()
+            if score >= self.FUZZY_CUTOFF:
+                for id in self.words[word]:
+                    matches[id] = max(matches.get(id, 0), score)
+        return matches
+
+    # Returns channels matching query, best first: exact matches, then
+    # prefixes of the id or name, prefixes of a word in them, anywhere in
+    # them, and (if fuzzy) close matches. An empty query matches every
+    # channel.
+    def search(self, query, limit=None, fuzzy=True):
+        query = query.strip().lower()
+        if not query:
+            return list(self.values())[:limit]
+        ids = self._substring(query)
+        key = lambda id: (self._rank(id, query), id)
+        ranked = sorted(ids, key=key) if limit is None else heapq.nsmallest(limit, ids, key=key)
+        if fuzzy and (limit is None or len(ranked) < limit):
+            close = self._fuzzy(query)
+            ranked += sorted((id for id in close if id not in ids), key=lambda id: (-close[id], id))
+        return [self[id] for id in ranked[:limit]]
+
+# Removes value from the set at mapping[key], and the set once it is
+# empty. Returns whether it was.
+def discard(mapping, key, value):
+    values = mapping[key]
+    values.discard(value)
+    if not values:
+        del mapping[key]
+        return True
+    return False
+
+def parse_channels(channel_url, cache, max_age=CHANNELS_MAX_AGE, quiet=False):
+    channels = ChannelDirectory()
+    try:
+        with perf.span("channels.parse"), cache.fetch_stream(channel_url, max_age=max_age) as fp:
+            with gzip.GzipFile(fileobj=fp) as gz:
+                for chan in iter_channels(gz):
+                    channels.add(chan)
+            fp.read()
     except Exception as e:
-        print("Error when fetching channel info: ")
+        if quiet:
+            raise
+        print("Error when fetching channel info: ", file=sys.stderr)
         abort(e)
 
-    channels = {}
-    for e in dom.getElementsByTagName("channel"):
-        channels[e.getAttribute("id")] = TVChannel(e)
-
     return channels
 
+@perf.timed("listings.compute")
 def get_program_listings(channels, start=None, end=None):
-    fil = lambda p: (start is None or end is None) or (p.end > start and p.start < end)
     listings = {}
     for c in channels:
-        listings[c.id] = sum(map(lambda d: list(filter(fil, c.programs[d])), c.programs), [])
-        listings[c.id].sort(key=lambda p: p.start)
+        listings[c.id] = c.index.window(start, end)
 
-    if sum([len(listings[id]) for id in listings]) == 0:
+    if not any(listings.values()):
         return None
     return listings